@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Runs synthetic jobs against a local server and workers, and prints one
+JSON object of measurements per run.
+
+Each run happens in a process of its own, so that its peak RSS is its own:
+
+    python bench.py --workload tiny --workload skewed --backend plain --clients 4
+"""
+import json
+import optparse
+import os
+import random
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import mincemeat
+
+WORKLOADS = ['tiny', 'huge', 'skewed', 'fanout']
+BACKENDS = ['plain', 'sqlite', 'batch']
+
+# Functions are sent to the workers as bare code, so they can't use this
+# module's globals.
+
+def wordcount_mapfn(k, v):
+    for w in v.split():
+        yield w, 1
+
+def fanout_mapfn(k, v):
+    for i in xrange(v[1]):
+        yield "k%d" % ((v[0] * 7919 + i) % 100000), 1
+
+def sum_reducefn(k, vs):
+    return sum(vs)
+
+def tiny_records(rng, scale):
+    """Many records of a few words each."""
+    words = ["w%d" % i for i in xrange(10000)]
+    return dict((i, " ".join(rng.choice(words) for j in xrange(8)))
+                for i in xrange(int(100000 * scale)))
+
+def huge_records(rng, scale):
+    """A few records of about 4MB each."""
+    words = ["w%d" % i for i in xrange(10000)]
+    return dict((i, " ".join(rng.choice(words) for j in xrange(800000)))
+                for i in xrange(max(int(8 * scale), 1)))
+
+def skewed_records(rng, scale):
+    """Word counts where word frequencies follow a power law, so a few keys
+    get most of the values."""
+    def word():
+        return "w%d" % min(int(rng.paretovariate(1.0)), 1000000)
+    return dict((i, " ".join(word() for j in xrange(20)))
+                for i in xrange(int(50000 * scale)))
+
+def fanout_records(rng, scale):
+    """Small records that each map to many keys."""
+    return dict((i, (i, 1000)) for i in xrange(int(2000 * scale)))
+
+def make_job(workload, rng, scale):
+    if workload == 'fanout':
+        return fanout_records(rng, scale), fanout_mapfn
+    records = {'tiny': tiny_records, 'huge': huge_records, 'skewed': skewed_records}[workload]
+    return records(rng, scale), wordcount_mapfn
+
+def make_server(backend, workdir):
+    if backend == 'plain':
+        return mincemeat.Server()
+    if backend == 'sqlite':
+        return mincemeat.SqliteServer(os.path.join(workdir, "bench.sqlite"))
+    if backend == 'batch':
+        return mincemeat.BatchSqliteServer(os.path.join(workdir, "bench.sqlite"), 1000)
+    raise ValueError("Unknown backend %s" % backend)
+
+def start_clients(options):
+    args = [sys.executable, os.path.abspath(mincemeat.__file__.replace(".pyc", ".py")),
+            "-p", options.password, "-P", str(options.port)]
+    args += shlex.split(options.client_args) + ["localhost"]
+    return [subprocess.Popen(args) for i in xrange(options.clients)]
+
+def run_one(workload, backend, options):
+    datasource, mapfn = make_job(workload, random.Random(options.seed), options.scale)
+    workdir = tempfile.mkdtemp(prefix="mincemeat-bench-")
+    try:
+        s = make_server(backend, workdir)
+        s.datasource = datasource
+        s.mapfn = mapfn
+        s.reducefn = sum_reducefn
+        clients = []
+        # The workers can only connect once the server is listening
+        starter = threading.Timer(options.client_delay, lambda: clients.extend(start_clients(options)))
+        starter.start()
+        started = time.time()
+        results = s.run_server(password=options.password, port=options.port)
+        keys = sum(1 for result in results)
+        wall = time.time() - started
+        starter.join()
+        for client in clients:
+            client.wait()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    tm = s.taskmanager
+    phases = tm.phase_started
+    map_seconds = phases[tm.REDUCING] - phases[tm.MAPPING]
+    reduce_seconds = phases[tm.FINISHED] - phases[tm.REDUCING]
+    tasks = tm.map_timer.completed + tm.reduce_timer.completed
+    job_seconds = map_seconds + reduce_seconds
+    bytes_moved = s.counters['wire_bytes_in'] + s.counters['wire_bytes_out']
+    return {
+        'workload': workload,
+        'backend': backend,
+        'clients': options.clients,
+        'client_args': options.client_args,
+        'scale': options.scale,
+        'records': len(datasource),
+        'keys': keys,
+        'map_tasks': tm.map_timer.completed,
+        'reduce_tasks': tm.reduce_timer.completed,
+        'map_seconds': map_seconds,
+        'reduce_seconds': reduce_seconds,
+        'wall_seconds': wall,
+        'tasks_per_second': tasks / job_seconds if job_seconds else None,
+        'wire_bytes_in': s.counters['wire_bytes_in'],
+        'wire_bytes_out': s.counters['wire_bytes_out'],
+        'bytes_per_second': bytes_moved / job_seconds if job_seconds else None,
+        # kilobytes on Linux
+        'server_peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--workload", dest="workloads", action="append", choices=WORKLOADS,
+                      help="workload to run, one of %s (repeatable; default all)" % ", ".join(WORKLOADS))
+    parser.add_option("--backend", dest="backends", action="append", choices=BACKENDS,
+                      help="server to run on, one of %s (repeatable; default all)" % ", ".join(BACKENDS))
+    parser.add_option("--clients", dest="clients", type="int", default=2, help="number of local workers")
+    parser.add_option("--client-args", dest="client_args", default="", help="extra arguments for each worker")
+    parser.add_option("--scale", dest="scale", type="float", default=1.0, help="multiplier for the number of records")
+    parser.add_option("--seed", dest="seed", type="int", default=0, help="random seed for the synthetic data")
+    parser.add_option("-p", "--password", dest="password", default="bench", help="password")
+    parser.add_option("-P", "--port", dest="port", type="int", default=mincemeat.DEFAULT_PORT, help="port")
+    parser.add_option("--client-delay", dest="client_delay", type="float", default=0.5,
+                      help="seconds to give the server to start listening")
+    parser.add_option("--run", dest="run", nargs=2, help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.run:
+        print json.dumps(run_one(options.run[0], options.run[1], options))
+        return
+
+    passthrough = sys.argv[1:]
+    for workload in options.workloads or WORKLOADS:
+        for backend in options.backends or BACKENDS:
+            # Each run gets a fresh process so its peak RSS is its own
+            output = subprocess.check_output([sys.executable, __file__, "--run", workload, backend] + passthrough)
+            sys.stdout.write(output)
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
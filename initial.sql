@@ -1,15 +1,26 @@
+drop table if exists map_results;
 create table map_results(
     key text,
-    value text
+    value text,
+    task blob
+);
+drop index if exists map_results_idx;
+
+drop table if exists map_tasks;
+create table map_tasks(
+    key blob primary key,
+    task blob
 );
-create index if not exists map_results_idx on map_results(key asc);
 
+drop table if exists reduce_results;
 create table reduce_results(
     key text unique primary key,
     value text
 );
-create index if not exists reduce_results_idx on reduce_results(key asc);
+drop index if exists reduce_results_idx;
+create index reduce_results_idx on reduce_results(key asc);
 
+drop table if exists state;
 create table state(
     current_state int
 );
@@ -2,10 +2,17 @@ drop table if exists map_results;
 create table map_results(
     key text,
     value text,
+    task blob,
     depth integer
 );
 drop index if exists map_results_idx;
-create index map_results_idx on map_results(depth asc, key asc);
+create index map_results_idx on map_results(depth asc);
+
+drop table if exists map_tasks;
+create table map_tasks(
+    key blob primary key,
+    task blob
+);
 
 drop table if exists reduce_results;
 create table reduce_results(
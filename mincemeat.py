@@ -23,29 +23,85 @@
 # THE SOFTWARE.
 ################################################################################
 
+import array
 import asynchat
 import asyncore
+import bisect
 import cPickle as pickle
 import hashlib
+import glob
+import heapq
 import hmac
 import logging
 import marshal
+import math
+import multiprocessing
+import operator
 import optparse
 import os
-import random
 import socket
 import sys
+import tempfile
+import time
+import threading
+import Queue
 import types
 import sqlite3
 import itertools
 import json
 import collections
+import cStringIO
+import bz2
+import errno
+import select
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+import zlib
+import struct
 
 VERSION = "0.1.2"
 
 
 DEFAULT_PORT = 11235
 
+# Binary framing: every frame is this header (flags, command length, payload
+# length) followed by the command and the encoded payload.
+FRAME_HEADER = struct.Struct("!BII")
+FRAME_BUFFER_SIZE = 65536
+CODEC_PICKLE = 0
+CODEC_MARSHAL = 1
+CODEC_MASK = 0x0f
+# Compressed payloads carry their compressor's id in the high bits of flags
+COMPRESSION_SHIFT = 4
+COMPRESSORS = {
+    'zlib': (1, lambda data: zlib.compress(data, 1), zlib.decompress),
+    'bz2': (2, bz2.compress, bz2.decompress),
+    }
+DECOMPRESSORS = dict((c[0], c[2]) for c in COMPRESSORS.values())
+# Payloads made only of these exact types go as marshal; marshal would turn
+# anything else with a buffer (bytearray, array.array, NumPy scalars) into a
+# plain str without complaint
+MARSHAL_ATOMS = frozenset([type(None), bool, int, long, float, complex, str, unicode])
+MARSHAL_SEQUENCES = frozenset([tuple, list, set, frozenset])
+
+def marshal_safe(data):
+    stack = [data]
+    while stack:
+        obj = stack.pop()
+        kind = type(obj)
+        if kind in MARSHAL_ATOMS:
+            continue
+        if kind in MARSHAL_SEQUENCES:
+            stack.extend(obj)
+        elif kind is dict:
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        else:
+            return False
+    return True
 
 
 class Protocol(asynchat.async_chat):
@@ -59,15 +115,171 @@ class Protocol(asynchat.async_chat):
         self.buffer = []
         self.auth = None
         self.mid_command = False
+        # Each direction switches to binary framing when the sender
+        # announces it with a 'binary' command
+        self.binary_in = self.binary_out = False
+        self.frame = None
+        # Outgoing payloads of compress_threshold bytes or more get compressed
+        # once a compressor has been agreed on
+        self.compression = None
+        self.compress_threshold = None
+        self.counters = collections.Counter()
+        # Anything received renews the other end's lease
+        self.last_heard = time.time()
+        # Bytes pushed but not yet handed to the socket
+        self.send_buffered = 0
 
     def collect_incoming_data(self, data):
-        self.buffer.append(data)
+        if self.frame is not None:
+            end = self.frame_pos + len(data)
+            self.frame_view[self.frame_pos:end] = data
+            self.frame_pos = end
+        else:
+            self.buffer.append(data)
+
+    def handle_read(self):
+        self.last_heard = time.time()
+        if self.frame is None or self.ac_in_buffer:
+            return asynchat.async_chat.handle_read(self)
+
+        # Mid-frame with nothing buffered: receive straight into the frame
+        try:
+            received = self.socket.recv_into(self.frame_view[self.frame_pos:])
+        except socket.error, why:
+            if why.args[0] in asynchat._BLOCKING_IO_ERRORS:
+                return
+            elif why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return
+            raise
+        if not received:
+            self.handle_close()
+            return
+        self.frame_pos += received
+        self.terminator = len(self.frame) - self.frame_pos
+        if not self.terminator:
+            self.found_terminator()
+
+    def push(self, data):
+        self.send_buffered += len(data)
+        asynchat.async_chat.push(self, data)
+
+    def push_with_producer(self, producer):
+        self.send_buffered += len(producer.data)
+        asynchat.async_chat.push_with_producer(self, producer)
+
+    def send(self, data):
+        sent = asynchat.async_chat.send(self, data)
+        self.send_buffered -= sent
+        return sent
+
+    def start_binary_framing(self):
+        self.send_command('binary')
+        self.binary_out = True
+        self.ac_out_buffer_size = FRAME_BUFFER_SIZE
+        # Headers go out ahead of large payloads in separate writes
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def set_binary_framing(self, command, data):
+        self.binary_in = True
+        self.ac_in_buffer_size = FRAME_BUFFER_SIZE
+        self.set_terminator(FRAME_HEADER.size)
+        if not self.binary_out:
+            self.start_binary_framing()
+
+    def set_compression(self, command, data):
+        self.compression, self.compress_threshold = data
+
+    def encode(self, data):
+        if marshal_safe(data):
+            try:
+                return CODEC_MARSHAL, marshal.dumps(data, 2)
+            except ValueError:
+                pass
+        return CODEC_PICKLE, pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, flags, payload):
+        started = time.time()
+        self.counters['wire_bytes_in'] += len(payload)
+        if flags >> COMPRESSION_SHIFT:
+            payload = DECOMPRESSORS[flags >> COMPRESSION_SHIFT](payload)
+            self.counters['compressed_frames_in'] += 1
+        self.counters['raw_bytes_in'] += len(payload)
+        if flags & CODEC_MASK == CODEC_MARSHAL:
+            data = marshal.loads(payload)
+        else:
+            data = pickle.load(cStringIO.StringIO(payload))
+        self.counters['decode_seconds'] += time.time() - started
+        return data
+
+    def compress(self, flags, payload):
+        compressor_id, compress, decompress = COMPRESSORS[self.compression]
+        compressed = compress(payload)
+        if len(compressed) >= len(payload):
+            return flags, payload
+        self.counters['compressed_frames_out'] += 1
+        return flags | compressor_id << COMPRESSION_SHIFT, compressed
+
+    def send_frame(self, command, data=None):
+        flags, payload = 0, ''
+        if data:
+            started = time.time()
+            flags, payload = self.encode(data)
+            self.counters['raw_bytes_out'] += len(payload)
+            if self.compression and len(payload) >= self.compress_threshold:
+                flags, payload = self.compress(flags, payload)
+            self.counters['wire_bytes_out'] += len(payload)
+            self.counters['encode_seconds'] += time.time() - started
+        logging.debug("<- %s (%d bytes)" % (command, len(payload)))
+        header = FRAME_HEADER.pack(flags, len(command), len(payload)) + command
+        if len(payload) <= self.ac_out_buffer_size:
+            self.push(header + payload)
+        else:
+            self.push(header)
+            self.push_with_producer(PayloadProducer(payload, self.ac_out_buffer_size))
+
+    def found_frame_part(self):
+        if self.frame is None:
+            flags, command_length, payload_length = FRAME_HEADER.unpack(''.join(self.buffer))
+            self.buffer = []
+            self.frame_flags = flags
+            self.frame_command_length = command_length
+            self.frame = bytearray(command_length + payload_length)
+            self.frame_view = memoryview(self.frame)
+            self.frame_pos = 0
+            self.set_terminator(len(self.frame))
+            return
+
+        frame, flags, command_length = self.frame, self.frame_flags, self.frame_command_length
+        self.frame = self.frame_view = None
+        self.set_terminator(FRAME_HEADER.size)
+
+        command, _, inline = str(frame[:command_length]).partition(":")
+        logging.debug("-> %s (%d bytes)" % (command, len(frame) - command_length))
+        if not self.auth == "Done":
+            if len(frame) > command_length:
+                logging.fatal("Recieved pickled data from unauthed source")
+                sys.exit(1)
+            self.process_unauthed_command(command, inline)
+        elif len(frame) > command_length:
+            self.process_command(command, self.decode(flags, buffer(frame, command_length)))
+        elif command == "challenge":
+            self.process_command(command, inline)
+        else:
+            self.process_command(command)
 
     def send_command(self, command, data=None):
+        if self.binary_out:
+            return self.send_frame(command, data)
         if not ":" in command:
             command += ":"
         if data:
+            started = time.time()
             pdata = pickle.dumps(data)
+            self.counters['encode_seconds'] += time.time() - started
+            # Text payloads go uncompressed
+            self.counters['raw_bytes_out'] += len(pdata)
+            self.counters['wire_bytes_out'] += len(pdata)
             command += str(len(pdata))
             logging.debug( "<- %s" % command)
             self.push(command + "\n" + pdata)
@@ -76,7 +288,9 @@ class Protocol(asynchat.async_chat):
             self.push(command + "\n")
 
     def found_terminator(self):
-        if not self.auth == "Done":
+        if self.binary_in:
+            self.found_frame_part()
+        elif not self.auth == "Done":
             command, data = (''.join(self.buffer).split(":",1))
             self.process_unauthed_command(command, data)
         elif not self.mid_command:
@@ -93,7 +307,12 @@ class Protocol(asynchat.async_chat):
             if not self.auth == "Done":
                 logging.fatal("Recieved pickled data from unauthed source")
                 sys.exit(1)
-            data = pickle.loads(''.join(self.buffer))
+            started = time.time()
+            pdata = ''.join(self.buffer)
+            self.counters['raw_bytes_in'] += len(pdata)
+            self.counters['wire_bytes_in'] += len(pdata)
+            data = pickle.loads(pdata)
+            self.counters['decode_seconds'] += time.time() - started
             self.set_terminator("\n")
             command = self.mid_command
             self.mid_command = None
@@ -120,6 +339,9 @@ class Protocol(asynchat.async_chat):
     def process_command(self, command, data=None):
         commands = {
             'challenge': self.respond_to_challenge,
+            'binary': self.set_binary_framing,
+            'compress': self.set_compression,
+            'heartbeat': lambda x, y: None,
             'disconnect': lambda x, y: self.handle_close(),
             }
 
@@ -143,15 +365,170 @@ class Protocol(asynchat.async_chat):
             self.handle_close()
         
 
+class WorkerJob(object):
+    """What a worker holds for one job: its functions, their code for pool
+    processes, its side data and, with processes > 1, its process pool."""
+
+    def __init__(self):
+        self.code = {}
+        self.functions = {}
+        self.sidedata = {}
+        self.columnar = None
+        self.pool = None
+
+    def activate(self):
+        # The functions look up pool_functions and sidedata as module globals
+        pool_functions.clear()
+        pool_functions.update(self.functions)
+        sidedata.clear()
+        sidedata.update(self.sidedata)
+
+    def start_pool(self, processes):
+        self.pool = multiprocessing.Pool(processes, init_pool_worker, (self.code, self.sidedata))
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+
 class Client(Protocol):
     def __init__(self):
         Protocol.__init__(self)
-        self.mapfn = self.reducefn = self.collectfn = None
+        # Setup of each job by id; a server running a single job doesn't
+        # name it, so its job is None
+        self.jobs = {}
+        self.job_id = None
+        # Number of tasks the server should keep queued on this connection
+        self.prefetch = 1
+        self.task_queue = collections.deque()
+        # With processes > 1, tasks are fanned out to a process pool per job
+        self.processes = 1
+        self.pending = []
+        # Sent to the server every stats_interval seconds, once it asks
+        self.stats_interval = None
+        self.stats_sent = 0
+        # Heartbeats go out from a thread of their own, so that they keep
+        # coming while a long task runs; sends are serialized by send_lock
+        self.heartbeat = None
+        self.send_lock = threading.RLock()
+        # No new task is started while more than this many bytes of
+        # results are waiting to go out
+        self.send_buffer_limit = 32 << 20
+        self.binary_framing = True
+        # Compressors the server may pick from for this connection
+        self.compressions = sorted(COMPRESSORS)
+        # Map output combining and spilling; see Combiner
+        self.combine_size = None
+        self.spill_size = None
+        # Locality tags of the data held here, such as the absolute paths of
+        # local input files; see Server.localityfn
+        self.holds = []
+        # Set once the server turns this worker away for failing too often
+        self.rejected = False
         
     def conn(self, server, port):
+        # Nothing from an earlier job carries over except the cache
+        pool_functions.clear()
+        sidedata.clear()
+        pinned_digests.clear()
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connect((server, port))
-        asyncore.loop()
+        # Service the socket between tasks so that queued tasks keep arriving
+        # and finished results go out while the next task is computed.
+        try:
+            while asyncore.socket_map:
+                if self.task_queue and not self.send_backlogged():
+                    timeout = 0
+                elif self.pending or self.task_queue:
+                    timeout = 0.05
+                else:
+                    timeout = 30.0
+                asyncore.loop(timeout=timeout, count=1)
+                if self.stats_interval and time.time() - self.stats_sent >= self.stats_interval:
+                    self.send_stats()
+                if self.processes > 1:
+                    self.collect_pool_results()
+                    while self.task_queue and self.connected and not self.send_backlogged():
+                        self.run_task()
+                elif self.task_queue and self.connected and not self.send_backlogged():
+                    self.run_task()
+        finally:
+            if self.heartbeat:
+                self.heartbeat.stop()
+                self.heartbeat.join()
+            for job in self.jobs.values():
+                job.close()
+
+    @property
+    def job(self):
+        if self.job_id not in self.jobs:
+            self.jobs[self.job_id] = WorkerJob()
+        return self.jobs[self.job_id]
+
+    def send_backlogged(self):
+        return self.send_buffered > self.send_buffer_limit
+
+    def run_task(self):
+        fn, command, data, self.job_id = self.task_queue.popleft()
+        try:
+            if self.processes == 1:
+                self.job.activate()
+            fn(command, data)
+        except:
+            self.handle_error()
+        finally:
+            self.job_id = None
+
+    def send_stats(self):
+        if self.connected and self.auth == "Done":
+            self.send_command('stats', dict(self.counters))
+        self.stats_sent = time.time()
+
+    def set_stats_interval(self, command, interval):
+        self.stats_interval = interval
+
+    def start_heartbeat(self, command, interval):
+        if not self.heartbeat:
+            self.heartbeat = HeartbeatThread(self, interval)
+            self.heartbeat.start()
+
+    def send_command(self, command, data=None):
+        with self.send_lock:
+            Protocol.send_command(self, command, data)
+
+    def initiate_send(self):
+        with self.send_lock:
+            Protocol.initiate_send(self)
+
+    def collect_pool_results(self):
+        for task in [task for task in self.pending if task[3].ready()]:
+            self.pending.remove(task)
+            job_id, reply, key, result, started = task
+            # Includes any wait for a free process
+            self.counters[reply + '_seconds'] += time.time() - started
+            try:
+                self.reply(job_id, reply, (key, result.get()))
+            except:
+                self.handle_error()
+
+    def run(self, reply, key, fn, *args):
+        # Time spent in the job's functions is counted by reply, as
+        # mapdone_seconds or reducedone_seconds
+        started = time.time()
+        if self.processes > 1:
+            if not self.job.pool:
+                self.job.start_pool(self.processes)
+            self.pending.append((self.job_id, reply, key, self.job.pool.apply_async(fn, args), started))
+        else:
+            result = fn(*args)
+            self.counters[reply + '_seconds'] += time.time() - started
+            self.reply(self.job_id, reply, (key, result))
+
+    def reply(self, job_id, command, data):
+        if job_id is None:
+            self.send_command(command, data)
+        else:
+            self.send_command('job', (job_id, command, data))
 
     def handle_connect(self):
         pass
@@ -159,54 +536,154 @@ class Client(Protocol):
     def handle_close(self):
         self.close()
 
+    def set_function(self, name, code):
+        digest = hashlib.sha1(code).hexdigest()
+        if digest not in job_cache:
+            cache_job_item(digest, (code, build_function(code, name)))
+        self.use_function(name, *job_cache[digest])
+
+    def use_function(self, name, code, function):
+        self.job.code[name] = code
+        self.job.functions[name] = function
+
     def set_mapfn(self, command, mapfn):
-        self.mapfn = types.FunctionType(marshal.loads(mapfn), globals(), 'mapfn')
+        self.set_function('mapfn', mapfn)
 
     def set_collectfn(self, command, collectfn):
-        self.collectfn = types.FunctionType(marshal.loads(collectfn), globals(), 'collectfn')
+        self.set_function('collectfn', collectfn)
 
     def set_reducefn(self, command, reducefn):
-        self.reducefn = types.FunctionType(marshal.loads(reducefn), globals(), 'reducefn')
+        self.set_function('reducefn', reducefn)
+
+    def set_columnar(self, command, op):
+        cache_job_item(hashlib.sha1(op).hexdigest(), op)
+        self.job.columnar = op
+
+    def set_sidedata(self, command, data):
+        name, digest, pdata = data
+        self.job.sidedata[name] = pickle.loads(pdata)
+        cache_job_item(digest, self.job.sidedata[name])
+
+    def use_cached(self, command, data):
+        command, name, digest = data
+        if digest not in job_cache:
+            logging.critical("Server sent %s %s by a digest that isn't cached" % (command, name))
+            self.handle_close()
+            return
+        item = job_cache.pop(digest)
+        job_cache[digest] = item
+        if command == 'sidedata':
+            self.job.sidedata[name] = item
+        elif command == 'columnar':
+            self.job.columnar = item
+        else:
+            self.use_function(name, *item)
 
     def call_mapfn(self, command, data):
         logging.info("Mapping %s" % str(data[0]))
-        results = {}
-        for k, v in self.mapfn(data[0], data[1]):
-            if k not in results:
-                results[k] = []
-            results[k].append(v)
-        if self.collectfn:
-            for k in results:
-                results[k] = [self.collectfn(k, results[k])]
-        self.send_command('mapdone', (data[0], results))
+        self.run('mapdone', data[0], pool_map, [data], self.combine_size, self.spill_size)
+
+    def call_mapfn_batch(self, command, data):
+        logging.info("Mapping batch %s (%d items)" % (data[0], len(data[1])))
+        self.run('mapdone', data[0], pool_map, data[1], self.combine_size, self.spill_size)
+
+    def call_mapfn_columns(self, command, data):
+        logging.info("Mapping batch %s (%d items) as columns" % (data[0], len(data[1])))
+        self.run('mapdone', data[0], pool_map_columns, data[1], self.job.columnar)
 
     def call_reducefn(self, command, data):
         logging.info("Reducing %s" % str(data[0]))
-        results = self.reducefn(data[0], data[1])
-        self.send_command('reducedone', (data[0], results))
+        self.run('reducedone', data[0], pool_reduce, data[0], data[1])
 
     def call_reducefn_partial(self, command, data):
         logging.info("Reducing partial %s" % str(data[0]))
-        results = self.reducefn(data[0][0], data[1])
-        self.send_command('reducedone', (data[0], results))
+        self.run('reducedone', data[0], pool_reduce, data[0][0], data[1])
+
+    def call_reducefn_raw(self, command, data):
+        logging.info("Reducing %s" % str(data[0]))
+        self.run('reducedone', data[0], pool_reduce_raw, data[0], data[1])
+
+    def call_reducefn_partial_raw(self, command, data):
+        logging.info("Reducing partial %s" % str(data[0]))
+        self.run('reducedone', data[0], pool_reduce_raw, data[0][0], data[1])
+
+    def process_job_command(self, command, data):
+        self.job_id, command, data = data
+        try:
+            self.process_command(command, data)
+        finally:
+            self.job_id = None
+
+    def end_job(self, command, job_id):
+        # Drop anything still queued or running for the job
+        self.task_queue = collections.deque(task for task in self.task_queue if task[3] != job_id)
+        self.pending = [task for task in self.pending if task[0] != job_id]
+        if job_id in self.jobs:
+            self.jobs.pop(job_id).close()
+
+    def turned_away(self, command, data):
+        logging.warning("Turned away by the server after failing too often")
+        self.rejected = True
+        self.handle_close()
         
     def process_command(self, command, data=None):
         commands = {
+            'job': self.process_job_command,
+            'endjob': self.end_job,
+            'rejected': self.turned_away,
+            'stats': self.set_stats_interval,
+            'heartbeat': self.start_heartbeat,
             'mapfn': self.set_mapfn,
             'collectfn': self.set_collectfn,
             'reducefn': self.set_reducefn,
+            'sidedata': self.set_sidedata,
+            'columnar': self.set_columnar,
+            'cached': self.use_cached,
+            }
+        tasks = {
             'map': self.call_mapfn,
+            'mapbatch': self.call_mapfn_batch,
+            'mapcolumns': self.call_mapfn_columns,
             'reduce': self.call_reducefn,
-            'partialreduce': self.call_reducefn_partial
+            'partialreduce': self.call_reducefn_partial,
+            'reduceraw': self.call_reducefn_raw,
+            'partialreduceraw': self.call_reducefn_partial_raw,
             }
 
-        if command in commands:
+        if command in tasks:
+            self.task_queue.append((tasks[command], command, data, self.job_id))
+        elif command in commands:
             commands[command](command, data)
         else:
             Protocol.process_command(self, command, data)
 
+    def hello(self):
+        return {
+            'prefetch': self.prefetch,
+            'binary_framing': self.binary_framing,
+            'compression': self.compressions,
+            'raw_values': True,
+            'cached': self.cached(),
+            'jobs': True,
+            'stats': True,
+            'holds': self.holds,
+            'heartbeat': True,
+            # Identifies the worker across reconnections
+            'worker': "%s:%d" % (socket.gethostname(), os.getpid()),
+            }
+
+    def cached(self):
+        # Whatever is advertised stays cached for as long as the connection
+        # lasts, since the server may name it at any time
+        pinned_digests.update(job_cache)
+        return list(job_cache)
+
     def post_auth_init(self):
         if not self.auth:
+            # Only the server's challenge has been answered so far, and ours
+            # goes out next. Sending pickled data ahead of it is safe because
+            # the server checks our auth reply before it reads hello.
+            self.send_command('hello', self.hello())
             self.send_challenge()
 
     def handle_error(self):
@@ -216,12 +693,38 @@ class Client(Protocol):
         else:
             Protocol.handle_error(self)
 
+class HeartbeatThread(threading.Thread):
+    """Sends the server a heartbeat every interval seconds, renewing the
+    lease on the worker's tasks."""
+
+    def __init__(self, client, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.client = client
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if self.client.connected:
+                    self.client.send_command('heartbeat')
+            except socket.error:
+                return
+
+    def stop(self):
+        self.stopped.set()
+
 
 class TaskManager(object):
     START = 0
     MAPPING = 1
     REDUCING = 2
     FINISHED = 3
+    STATE_NAMES = {START: 'start', MAPPING: 'mapping', REDUCING: 'reducing', FINISHED: 'finished'}
+    # Sent with each reduce task; the "raw" variants carry each value still
+    # pickled, to be unpickled by the worker
+    REDUCE_COMMAND = 'reduce'
 
     @property
     def state(self):
@@ -235,67 +738,334 @@ class TaskManager(object):
         self.datasource = datasource
         self.server = server
         self.state = TaskManager.START
+        # When each phase started, by state
+        self.phase_started = {}
+        self.counters = collections.Counter()
+        # Reduce tasks that became possible as other reduces finished, handed
+        # out ahead of the reduce iterator
+        self.ready = collections.deque()
 
     def next_task(self, channel):
         if self.state == TaskManager.START:
-            self.map_iter = iter(self.datasource)
-            self.working_maps = {}
-            self.map_results = {}
-            #self.waiting_for_maps = []
+            self.start()
             self.state = TaskManager.MAPPING
         if self.state == TaskManager.MAPPING:
+            while self.lost_maps:
+                map_key = self.lost_maps.popleft()
+                if map_key in self.working_maps:
+                    self.map_timer.started(map_key, channel)
+                    return (self.map_command, (map_key, self.working_maps[map_key]))
             try:
-                map_key = self.map_iter.next()
-                map_item = map_key, self.datasource[map_key]
+                map_item = self.next_map_item(channel)
                 self.working_maps[map_item[0]] = map_item[1]
-                return ('map', map_item)
+                self.map_timer.started(map_item[0], channel)
+                return (self.map_command, map_item)
             except StopIteration:
                 if len(self.working_maps) > 0:
-                    key = random.choice(self.working_maps.keys())
-                    return ('map', (key, self.working_maps[key]))
+                    return self.map_tail_task(channel)
                 self.state = TaskManager.REDUCING
+                self.phase_started[TaskManager.REDUCING] = time.time()
                 self.reduce_iter = self.get_reduce_iter()
-                self.working_reduces = {}
-                self.results = {}
                 return self.next_task(channel)
         if self.state == TaskManager.REDUCING:
+            if self.ready:
+                return self.issue_reduce(self.ready.popleft(), channel)
             try:
-                reduce_item = self.reduce_iter.next()
-                self.working_reduces[reduce_item[0]] = reduce_item[1]
-                return ('reduce', reduce_item)
+                return self.issue_reduce(self.reduce_iter.next(), channel)
             except StopIteration:
                 if len(self.working_reduces) > 0:
-                    key = random.choice(self.working_reduces.keys())
-                    return ('reduce', (key, self.working_reduces[key]))
+                    command, reduce_item = self.speculative_task(self.working_reduces, self.reduce_timer, self.REDUCE_COMMAND, channel)
+                    if command:
+                        command = self.reduce_command(reduce_item[0])
+                    return command, reduce_item
                 self.state = TaskManager.FINISHED
         if self.state == TaskManager.FINISHED:
+            self.phase_started.setdefault(TaskManager.FINISHED, time.time())
             self.server.handle_close()
             return ('disconnect', None)
     
-    def map_done(self, data):
+    def start(self):
+        self.phase_started[TaskManager.MAPPING] = time.time()
+        self.map_iter = iter(self.datasource)
+        # Built from map_iter on first use, with a localityfn
+        self.locality = None
+        self.working_maps = {}
+        self.map_results = {}
+        #self.waiting_for_maps = []
+        self.columnar = self.server.columnar
+        self.batching = self.server.map_batch_size > 1 or bool(self.server.map_batch_bytes) or bool(self.columnar)
+        if self.columnar:
+            self.map_command = 'mapcolumns'
+        else:
+            self.map_command = 'mapbatch' if self.batching else 'map'
+        self.batch_ids = itertools.count()
+        self.working_reduces = {}
+        self.results = {}
+        # Values and estimated bytes of map output per key, and the split
+        # reduces of hot keys
+        self.value_counts = collections.Counter()
+        self.value_sizes = {}
+        self.pieces = set()
+        self.splits = {}
+        # Cache digests of the map tasks out, with server.map_cache
+        self.map_digests = {}
+        if self.server.map_cache:
+            self.map_code_digest = hashlib.sha1(''.join(
+                digest for command, name, digest, data in self.server.job_setup
+                if command != 'reducefn')).hexdigest()
+        self.map_timer = TaskTimer()
+        self.reduce_timer = TaskTimer()
+        self.worker_stats = {}
+        # Map tasks of lost workers, handed out ahead of any others
+        self.lost_maps = collections.deque()
+
+    def next_map_item(self, channel):
+        # Map tasks whose output is found in server.map_cache are done on
+        # the spot
+        while True:
+            if self.batching:
+                map_item = next(self.batch_ids), self.next_map_batch(channel)
+                items = map_item[1]
+            else:
+                map_key = self.next_map_key(channel)
+                map_item = map_key, self.datasource[map_key]
+                items = [map_item]
+            if not self.server.map_cache:
+                return map_item
+            digest = self.server.map_cache.task_digest(self.map_code_digest, items)
+            results = self.server.map_cache.get(digest)
+            if results is None:
+                self.map_digests[map_item[0]] = digest
+                return map_item
+            self.save_map_task(map_item, results)
+
+    def next_map_key(self, channel):
+        localityfn = self.server.localityfn or getattr(self.datasource, 'locality', None)
+        if not localityfn:
+            return self.map_iter.next()
+        if self.locality is None:
+            self.locality = LocalityQueue(self.map_iter, lambda key: localityfn(key, self.datasource[key]),
+                                          self.server.holders)
+        map_key, local = self.locality.pop(channel.holds)
+        self.counters['local_maps' if local else 'remote_maps'] += 1
+        return map_key
+
+    def next_map_batch(self, channel):
+        # A batch is closed off by whichever of map_batch_size (items) or
+        # map_batch_bytes (approximate value size) is hit first.
+        batch = []
+        size = 0
+        while True:
+            try:
+                map_key = self.next_map_key(channel)
+            except StopIteration:
+                break
+            value = self.datasource[map_key]
+            batch.append((map_key, value))
+            if self.server.map_batch_bytes:
+                size += payload_size(value)
+                if size >= self.server.map_batch_bytes:
+                    break
+                if self.server.map_batch_size > 1 and len(batch) >= self.server.map_batch_size:
+                    break
+            elif len(batch) >= self.server.map_batch_size:
+                break
+        if not batch:
+            raise StopIteration
+        return batch
+
+    def issue_reduce(self, reduce_item, channel):
+        self.working_reduces[reduce_item[0]] = reduce_item[1]
+        self.reduce_timer.started(reduce_item[0], channel)
+        return (self.reduce_command(reduce_item[0]), reduce_item)
+
+    def reduce_command(self, key):
+        if key in self.pieces:
+            return 'partialreduce'
+        return self.REDUCE_COMMAND
+
+    def map_tail_task(self, channel):
+        # Called once every map task has been handed out but some are
+        # still running
+        return self.speculative_task(self.working_maps, self.map_timer, self.map_command, channel)
+
+    def task_finished(self, timer, key, channel):
+        duration = timer.finished(key)
+        stats = self.worker_stats.setdefault(channel, [0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+
+    def overdue_channels(self, timeout, now):
+        if not hasattr(self, 'map_timer'):
+            return set()
+        return self.map_timer.overdue(timeout, now) | self.reduce_timer.overdue(timeout, now)
+
+    def backlogged(self):
+        # Whether results are coming in faster than they can be saved, in
+        # which case the server stops reading them for a while
+        return False
+
+    def channel_lost(self, channel):
+        """Puts the tasks that only channel had a copy of back at the front
+        of the line. Returns whether channel had any tasks."""
+        if not hasattr(self, 'map_timer'):
+            return False
+        owned = any(channel in owners for timer in (self.map_timer, self.reduce_timer)
+                    for owners in timer.owners.itervalues())
+        maps = self.map_timer.lost(channel)
+        reduces = self.reduce_timer.lost(channel)
+        if maps or reduces:
+            logging.info("Requeuing %d map and %d reduce tasks" % (len(maps), len(reduces)))
+        self.lost_maps.extend(maps)
+        self.ready.extendleft((key, self.working_reduces[key]) for key in reversed(reduces))
+        return owned
+
+    def holders_changed(self, tags):
+        if getattr(self, 'locality', None):
+            self.locality.holders_changed(tags)
+
+    def speculative_task(self, working, timer, command, channel):
+        """Once there is no fresh work left, hands channel a copy of the
+        oldest task that has been running for more than
+        server.speculative_slowdown times the median task time, as long as
+        the task has fewer than server.max_task_copies copies out and channel
+        isn't itself slower than that."""
+        if not timer.durations:
+            return (None, None)
+        threshold = timer.median() * self.server.speculative_slowdown
+        stats = self.worker_stats.get(channel)
+        if stats and stats[1] / stats[0] > threshold:
+            return (None, None)
+        now = time.time()
+        for key, started in timer.start_times.iteritems():
+            if now - started <= threshold:
+                break
+            if timer.copies[key] < self.server.max_task_copies and channel not in timer.owners[key]:
+                logging.info("Speculatively re-issuing %s" % str(key))
+                timer.started(key, channel)
+                return (command, (key, working[key]))
+        return (None, None)
+
+    def map_done(self, data, channel=None):
         # Don't use the results if they've already been counted
         if not data[0] in self.working_maps:
             return
 
-        self.save_map_results(data[0], data[1].iteritems())
+        if self.columnar:
+            data = data[0], columns_to_results(data[1])
+        self.save_map_task((data[0], self.working_maps[data[0]]), data[1])
+        if data[0] in self.map_digests:
+            self.server.map_cache.put(self.map_digests.pop(data[0]), data[1])
         del self.working_maps[data[0]]
+        self.task_finished(self.map_timer, data[0], channel)
+
+    def save_map_task(self, map_item, results):
+        self.save_map_results(map_item[0], results.iteritems())
 
     def save_map_results(self, key, results):
         for (key, values) in results:
             if key not in self.map_results:
                 self.map_results[key] = []
+                # Size a key's values by its first one
+                self.value_sizes[key] = payload_size(values[0]) if values else 0
             self.map_results[key].extend(values)
+            self.value_counts[key] += len(values)
+
+    def value_bytes(self, key):
+        return self.value_counts[key] * self.value_sizes[key]
+
+    def split_threshold(self):
+        """Returns the estimated size in bytes past which a key's values are
+        split across several reduces, or None if keys aren't split.
+
+        Splitting needs a reducefn marked associative. A key is split when it
+        is at least server.split_skew times the size of the average key and
+        at least server.split_bytes, into pieces of about that size.
+        """
+        if not self.server.split_skew or not getattr(self.server.reducefn, 'associative', False):
+            return None
+        if not self.value_counts:
+            return None
+        mean = sum(self.value_bytes(key) for key in self.value_counts) / float(len(self.value_counts))
+        return max(mean * self.server.split_skew, self.server.split_bytes)
 
     def get_reduce_iter(self):
-        return self.map_results.iteritems()
+        threshold = self.split_threshold()
+        for key, values in self.map_results.iteritems():
+            if threshold is None or self.value_bytes(key) <= threshold:
+                yield key, values
+                continue
+            pieces = min(int(math.ceil(self.value_bytes(key) / threshold)), len(values))
+            size = int(math.ceil(len(values) / float(pieces)))
+            # Rounding the size up can leave fewer pieces than asked for,
+            # and no piece may be empty
+            pieces = int(math.ceil(len(values) / float(size)))
+            logging.info("Splitting hot key %s into %d reduces" % (str(key), pieces))
+            self.splits[key] = (pieces, [])
+            for piece in xrange(pieces):
+                self.pieces.add((key, piece, 0))
+                yield (key, piece, 0), values[piece * size:(piece + 1) * size]
+
+    def status(self):
+        now = time.time()
+        phases = {}
+        for state, started in self.phase_started.items():
+            if state == TaskManager.FINISHED:
+                continue
+            ended = [t for s, t in self.phase_started.items() if s > state]
+            phases[TaskManager.STATE_NAMES[state]] = (min(ended) if ended else now) - started
+        status = {
+            'state': TaskManager.STATE_NAMES[self.state],
+            'phase_seconds': phases,
+            'counters': dict(self.counters),
+            'ready_reduces': len(self.ready),
+            }
+        if hasattr(self, 'map_timer'):
+            for name, timer, working in (('map', self.map_timer, self.working_maps),
+                                         ('reduce', self.reduce_timer, self.working_reduces)):
+                status[name + '_tasks'] = {
+                    'dispatched': timer.dispatched,
+                    'reissued': timer.reissued,
+                    'completed': timer.completed,
+                    'out': len(working),
+                    'median_seconds': timer.median() if timer.durations else None,
+                    }
+        return status
+
+    def skew_report(self, top=10):
+        """Summarizes the distribution of map output over keys, listing the
+        top biggest keys by estimated size."""
+        counts = sorted(self.value_counts.itervalues())
+        biggest = heapq.nlargest(top, self.value_counts, key=self.value_bytes)
+        return {
+            'keys': len(counts),
+            'values': sum(counts),
+            'median_values': counts[len(counts) // 2] if counts else 0,
+            'max_values': counts[-1] if counts else 0,
+            'split_threshold': self.split_threshold(),
+            'top_keys': [{
+                'key': key,
+                'values': self.value_counts[key],
+                'bytes': self.value_bytes(key),
+                'reduces': self.splits[key][0] if key in self.splits else 1,
+                } for key in biggest],
+            }
                                 
-    def reduce_done(self, data):
+    def reduce_done(self, data, channel=None):
         # Don't use the results if they've already been counted
         if not data[0] in self.working_reduces:
             return
 
-        self.save_reduce_results(data[0], data[1])
+        if data[0] in self.pieces:
+            # Once every piece of a split key is in, reduce their results
+            pieces, partials = self.splits[data[0][0]]
+            partials.append(data[1])
+            if len(partials) == pieces:
+                self.ready.append((data[0][0], partials))
+        else:
+            self.save_reduce_results(data[0], data[1])
         del self.working_reduces[data[0]]
+        self.task_finished(self.reduce_timer, data[0], channel)
 
     def save_reduce_results(self, key, result):
         self.results[key] = result
@@ -303,6 +1073,73 @@ class TaskManager(object):
     def get_results(self):
         return self.results.iteritems()
 
+class TaskTimer(object):
+    """Dispatch and run times of one kind of task, used to spot stragglers."""
+
+    # How many of the latest run times the median is taken over
+    window = 1000
+
+    def __init__(self):
+        # Dispatch time of every unfinished task, oldest first
+        self.start_times = collections.OrderedDict()
+        self.copies = {}
+        self.owners = {}
+        # Dispatch time of each copy, by (task, channel)
+        self.leases = {}
+        # Run times of the latest finished tasks, in finishing order and
+        # sorted
+        self.recent = collections.deque()
+        self.durations = []
+        self.dispatched = self.reissued = self.completed = 0
+
+    def started(self, key, channel):
+        if key not in self.start_times:
+            self.start_times[key] = time.time()
+            self.copies[key] = 0
+            self.owners[key] = set()
+        else:
+            self.reissued += 1
+        self.dispatched += 1
+        self.copies[key] += 1
+        self.owners[key].add(channel)
+        self.leases[key, channel] = time.time()
+
+    def lost(self, channel):
+        """Drops channel's copies of tasks, forgetting and returning the
+        tasks left with no copy."""
+        lost = []
+        for key, owners in self.owners.items():
+            if channel in owners:
+                owners.discard(channel)
+                del self.leases[key, channel]
+                self.copies[key] -= 1
+                if not owners:
+                    del self.start_times[key], self.copies[key], self.owners[key]
+                    lost.append(key)
+        self.reissued += len(lost)
+        return lost
+
+    def finished(self, key):
+        duration = time.time() - self.start_times.pop(key)
+        for channel in self.owners.pop(key):
+            del self.leases[key, channel]
+        del self.copies[key]
+        self.completed += 1
+        self.recent.append(duration)
+        bisect.insort(self.durations, duration)
+        if len(self.recent) > self.window:
+            del self.durations[bisect.bisect_left(self.durations, self.recent.popleft())]
+        return duration
+
+    def overdue(self, timeout, now):
+        """Returns the channels that have held a copy of a task for more
+        than timeout seconds."""
+        return set(channel for (key, channel), started in self.leases.iteritems()
+                   if now - started > timeout)
+
+    def median(self):
+        return self.durations[len(self.durations) // 2]
+
 class Server(asyncore.dispatcher, object):
     taskmanager_cls = TaskManager
 
@@ -313,27 +1150,201 @@ class Server(asyncore.dispatcher, object):
         self.collectfn = None
         self.datasource = None
         self.password = None
+        # Map tasks carry map_batch_size datasource items, or as many as fit
+        # in map_batch_bytes when that is set.
+        self.map_batch_size = 1
+        self.map_batch_bytes = None
+        # With columnar set to one of COLUMN_OPS, mapfn(keys, values) maps a
+        # whole batch at once, returning a (keys, values) pair of numeric
+        # arrays, which the worker aggregates by key with that operation
+        self.columnar = None
+        # Use the binary wire format with workers that support it
+        self.binary_framing = True
+        # With binary framing, payloads of at least compress_threshold bytes
+        # are compressed with this compressor ('zlib' or 'bz2') if the
+        # worker supports it
+        self.compression = None
+        self.compress_threshold = 16384
+        # Totals of each channel's counters, added as channels close
+        self.counters = collections.Counter()
+        # Tasks still running at the end of a phase get re-issued once they
+        # take speculative_slowdown times the median task time, up to
+        # max_task_copies copies in all
+        self.speculative_slowdown = 2.0
+        self.max_task_copies = 2
+        # With an associative reducefn, keys with at least split_skew times
+        # the average key's map output, and at least split_bytes of it, are
+        # reduced in several pieces; see TaskManager.split_threshold
+        self.split_skew = 8.0
+        self.split_bytes = 1 << 20
+        # Named objects for the job's functions to look up in
+        # mincemeat.sidedata on the workers
+        self.sidedata = {}
+        # A MapCache to take the output of unchanged map tasks from
+        self.map_cache = None
+        # With localityfn(key, value) returning the tags of the data a
+        # datasource item needs (such as the file an InputSplit reads), map
+        # tasks go to workers holding those tags first; see LocalityQueue.
+        # holders counts the connected workers holding each tag.
+        self.localityfn = None
+        self.holders = collections.Counter()
+        # Workers send a heartbeat every heartbeat_interval seconds. One not
+        # heard from in lease_timeout seconds is dropped, as is one that has
+        # held a task for task_timeout seconds (counting from dispatch), and
+        # the tasks of a dropped worker are handed out again at once. A
+        # worker dropped with tasks max_worker_failures times is turned away
+        # from then on.
+        self.heartbeat_interval = 5.0
+        self.lease_timeout = 30.0
+        self.task_timeout = None
+        self.max_worker_failures = 3
+        self.worker_failures = collections.Counter()
+        # Workers report their counters every worker_stats_interval seconds.
+        # With status_address set, status() is served there as JSON over
+        # HTTP; with profile_path set, it is written there at the end.
+        self.worker_stats_interval = 5.0
+        self.status_address = None
+        self.status_server = None
+        self.profile_path = None
+        self.started = None
+        # Channels that were left without work, woken up as tasks finish and
+        # at least every tick_interval seconds
+        self.channels = set()
+        self.idle_channels = set()
+        self.tick_interval = 1.0
+        self.last_tick = 0
+        # Connections waiting to be accepted, for many workers starting at
+        # once
+        self.listen_backlog = 1024
 
     def run_server(self, password="", port=DEFAULT_PORT):
         self.password = password
+        self.job_setup = self.get_job_setup()
+        self.started = time.time()
+        if self.status_address:
+            self.status_server = StatusServer(self, self.status_address)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        # The server closes worker connections itself when a job finishes,
+        # so the port can be left in TIME_WAIT
+        self.set_reuse_addr()
         self.bind(("", port))
-        self.listen(1)
+        self.listen(self.listen_backlog)
+        poll = make_poller()
         try:
-            asyncore.loop()
+            while asyncore.socket_map:
+                # While reading is paused, check back soon
+                poll(0.05 if self.backlogged() else self.tick_interval, asyncore.socket_map)
+                self.tick()
         except:
             self.close_all()
             raise
-        
+
+        if self.profile_path:
+            write_profile(self.profile_path, self.status())
+        return self.get_results()
+
+    def get_results(self):
         return self.taskmanager.get_results()
 
+    def next_task(self, channel):
+        return self.taskmanager.next_task(channel)
+
+    def disconnect_all(self):
+        # Let every worker go, including any still busy with a task that has
+        # since been finished elsewhere
+        for channel in list(self.channels):
+            channel.send_command('disconnect')
+            channel.close_when_done()
+
     def handle_accept(self):
-        conn, addr = self.accept()
-        sc = ServerChannel(conn, self)
-        sc.password = self.password
+        # Take every connection waiting, not just one per poll
+        while True:
+            pair = self.accept()
+            if pair is None:
+                return
+            conn, addr = pair
+            sc = ServerChannel(conn, self)
+            sc.password = self.password
 
     def handle_close(self):
         self.close()
+        if self.status_server:
+            self.status_server.close()
+
+    def status(self):
+        """Returns counters and queue depths for the server, its job and
+        each connected worker."""
+        counters = collections.Counter(self.counters)
+        for channel in self.channels:
+            counters.update(channel.counters)
+        status = {
+            'uptime': time.time() - self.started if self.started else 0,
+            'counters': dict(counters),
+            'workers': [channel.status() for channel in self.channels],
+            'idle_workers': len(self.idle_channels),
+            'worker_failures': dict(self.worker_failures),
+            }
+        if hasattr(self, 'taskmanager'):
+            status['job'] = self.taskmanager.status()
+        return status
+
+    def tick(self):
+        now = time.time()
+        if now - self.last_tick >= self.tick_interval:
+            self.last_tick = now
+            self.expire_leases(now)
+            self.wake_idle()
+
+    def expire_leases(self, now):
+        if self.task_timeout:
+            # A worker stuck in a task still sends heartbeats
+            for channel in self.overdue_channels(self.task_timeout, now):
+                if channel in self.channels:
+                    logging.warning("Worker %s has held a task for over %.0f seconds, dropping it" % (channel.worker, self.task_timeout))
+                    channel.handle_close()
+        if not self.lease_timeout:
+            return
+        for channel in list(self.channels):
+            # Nothing is read from a channel while the server is backlogged
+            if not channel.readable():
+                continue
+            if channel.heartbeats and now - channel.last_heard > self.lease_timeout:
+                logging.warning("No word from worker %s in %.0f seconds, dropping it" % (channel.worker, now - channel.last_heard))
+                channel.handle_close()
+
+    def channel_lost(self, channel):
+        return hasattr(self, 'taskmanager') and self.taskmanager.channel_lost(channel)
+
+    def overdue_channels(self, timeout, now):
+        if not hasattr(self, 'taskmanager'):
+            return set()
+        return self.taskmanager.overdue_channels(timeout, now)
+
+    def backlogged(self):
+        return hasattr(self, 'taskmanager') and self.taskmanager.backlogged()
+
+    def holders_changed(self, tags):
+        if hasattr(self, 'taskmanager'):
+            self.taskmanager.holders_changed(tags)
+
+    def worker_failed(self, channel):
+        self.worker_failures[channel.worker] += 1
+        if self.blacklisted(channel):
+            logging.warning("Worker %s failed %d times, turning it away" % (channel.worker, self.worker_failures[channel.worker]))
+
+    def blacklisted(self, channel):
+        return bool(self.max_worker_failures) and self.worker_failures[channel.worker] >= self.max_worker_failures
+
+    def wake_idle(self):
+        idle, self.idle_channels = self.idle_channels, set()
+        for channel in idle:
+            channel.start_new_task()
+
+    def skew_report(self, top=10):
+        return self.taskmanager.skew_report(top)
+
+    def get_job_setup(self):
+        return get_job_setup(self)
 
     def set_datasource(self, ds):
         self._datasource = ds
@@ -349,34 +1360,131 @@ class ServerChannel(Protocol):
     def __init__(self, conn, server):
         Protocol.__init__(self, conn)
         self.server = server
+        self.options = {}
+        self.tasks_in_flight = 0
+        # With a JobServer: the jobs this worker has been set up for, and
+        # its tasks in flight for each
+        self.jobs = set()
+        self.job_tasks = collections.Counter()
+        # Latest totals reported by the worker
+        self.worker_counters = {}
+        # Locality tags of the data this worker holds, from its hello
+        self.holds = frozenset()
+        # Set once the worker has been asked for heartbeats
+        self.heartbeats = False
+        server.channels.add(self)
 
         self.start_auth()
 
     def handle_close(self):
         logging.info("Client disconnected")
+        self.server.counters.update(self.counters)
+        self.server.channels.discard(self)
+        self.server.idle_channels.discard(self)
+        self.server.holders.subtract(self.holds)
+        self.server.holders_changed(self.holds)
+        for job_id, tasks in self.job_tasks.items():
+            if job_id in self.server.jobs:
+                self.server.jobs[job_id].tasks_in_flight -= tasks
         self.close()
+        # Whatever it was working on goes to the other workers
+        if self.server.channel_lost(self):
+            self.server.worker_failed(self)
+            self.server.wake_idle()
+
+    @property
+    def worker(self):
+        return self.options.get('worker') or "%s:%s" % self.addr[:2]
+
+    def readable(self):
+        return not self.server.backlogged()
 
     def start_auth(self):
         self.send_challenge()
 
     def start_new_task(self):
-        command, data = self.server.taskmanager.next_task(self)
-        if command == None:
-            return
-        self.send_command(command, data)
+        # Keep up to the worker's advertised prefetch depth of tasks queued
+        while self.tasks_in_flight < self.options.get('prefetch', 1):
+            command, data = self.server.next_task(self)
+            if command == None:
+                self.server.idle_channels.add(self)
+                return
+            if command == 'disconnect':
+                self.server.disconnect_all()
+                return
+            if command.endswith('raw') and not self.options.get('raw_values'):
+                command, data = command[:-3], (data[0], [pickle.loads(value) for value in data[1]])
+            self.send_command(command, data)
+            self.tasks_in_flight += 1
+
+    def hello(self, command, data):
+        self.options = data
+        self.holds = frozenset(data.get('holds', ()))
+        self.server.holders.update(self.holds)
+        self.server.holders_changed(self.holds)
 
     def map_done(self, command, data):
-        self.server.taskmanager.map_done(data)
-        self.start_new_task()
+        self.task_done(self.server.taskmanager, command, data)
 
     def reduce_done(self, command, data):
-        self.server.taskmanager.reduce_done(data)
+        self.task_done(self.server.taskmanager, command, data)
+
+    def job_done(self, command, data):
+        job_id, command, data = data
+        if job_id not in self.jobs:
+            # Sent before the worker heard the job was over; its slot was
+            # given back then
+            return
+        self.job_tasks[job_id] -= 1
+        job = self.server.jobs.get(job_id)
+        if job:
+            job.tasks_in_flight -= 1
+        self.task_done(job and job.taskmanager, command, data)
+
+    def task_done(self, taskmanager, command, data):
+        self.tasks_in_flight -= 1
+        self.counters[command] += 1
+        if taskmanager:
+            # Time taken to take in the results, mostly saving them
+            started = time.time()
+            if command == 'mapdone':
+                taskmanager.map_done(data, self)
+            else:
+                taskmanager.reduce_done(data, self)
+            taskmanager.counters[command + '_seconds'] += time.time() - started
         self.start_new_task()
+        self.server.wake_idle()
+
+    def set_worker_counters(self, command, data):
+        self.worker_counters = data
+
+    def status(self):
+        return {
+            'address': "%s:%s" % self.addr[:2],
+            'tasks_in_flight': self.tasks_in_flight,
+            'idle': self in self.server.idle_channels,
+            'counters': dict(self.counters),
+            'worker_counters': self.worker_counters,
+            }
+
+    def send_job_setup(self, setup, job_id=None):
+        # Anything the worker kept from an earlier job is named by its digest
+        cached = set(self.options.get('cached', ()))
+        for command, name, digest, data in setup:
+            if digest in cached:
+                command, data = 'cached', (command, name, digest)
+            if job_id is None:
+                self.send_command(command, data)
+            else:
+                self.send_command('job', (job_id, command, data))
 
     def process_command(self, command, data=None):
         commands = {
+            'hello': self.hello,
             'mapdone': self.map_done,
             'reducedone': self.reduce_done,
+            'job': self.job_done,
+            'stats': self.set_worker_counters,
             }
 
         if command in commands:
@@ -385,16 +1493,187 @@ class ServerChannel(Protocol):
             Protocol.process_command(self, command, data)
 
     def post_auth_init(self):
-        if self.server.mapfn:
-            self.send_command('mapfn', marshal.dumps(self.server.mapfn.func_code))
-        if self.server.reducefn:
-            self.send_command('reducefn', marshal.dumps(self.server.reducefn.func_code))
-        if self.server.collectfn:
-            self.send_command('collectfn', marshal.dumps(self.server.collectfn.func_code))
+        if self.server.blacklisted(self):
+            logging.info("Turning away worker %s" % self.worker)
+            self.send_command('rejected')
+            self.close_when_done()
+            return
+        if self.server.worker_stats_interval and self.options.get('stats'):
+            self.send_command('stats', self.server.worker_stats_interval)
+        if self.server.binary_framing and self.options.get('binary_framing'):
+            self.start_binary_framing()
+            if self.server.compression in self.options.get('compression', ()):
+                compression = (self.server.compression, self.server.compress_threshold)
+                self.send_command('compress', compression)
+                self.set_compression('compress', compression)
+        # Once the framing is settled, as the worker sends them from a thread
+        if self.server.heartbeat_interval and self.options.get('heartbeat'):
+            self.send_command('heartbeat', self.server.heartbeat_interval)
+            self.heartbeats = True
+        self.send_job_setup(self.server.job_setup)
         self.start_new_task()
 
+class Job(object):
+    """One of the jobs run by a JobServer.
+
+    A Job is set up like a Server, with a datasource and functions, and
+    stands in for the Server as far as its TaskManager is concerned. Any
+    setting it doesn't override, such as map_batch_size, is the JobServer's.
+    """
+    taskmanager_cls = TaskManager
+
+    def __init__(self, server):
+        self.jobserver = server
+        self.id = None
+        self.mapfn = None
+        self.reducefn = None
+        self.collectfn = None
+        self.columnar = None
+        self.sidedata = {}
+        self.profile_path = None
+        self.tasks_in_flight = 0
+        self.job_setup = None
+        self.finished = threading.Event()
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('jobserver', '_datasource', 'taskmanager'):
+            raise AttributeError(name)
+        return getattr(self.jobserver, name)
+
+    def handle_close(self):
+        self.jobserver.finish_job(self)
+
+    def wait(self, timeout=None):
+        """Waits for the job to finish and returns its results."""
+        self.finished.wait(timeout)
+        if not self.finished.is_set():
+            return None
+        return self.taskmanager.get_results()
+
+    def set_datasource(self, ds):
+        self._datasource = ds
+        self.taskmanager = self.taskmanager_cls(self._datasource, self)
+    
+    def get_datasource(self):
+        return self._datasource
+
+    datasource = property(get_datasource, set_datasource)
+
+class JobServer(Server):
+    """Runs any number of Jobs side by side on the same workers, which stay
+    connected from one job to the next.
+
+    Jobs can be submitted from other threads while the server runs. Each
+    free slot on a worker goes to the job with the fewest tasks in flight.
+    With exit_when_idle set, run_server returns once no job is left;
+    otherwise it runs until stop() is called.
+    """
+
+    def __init__(self):
+        super(JobServer, self).__init__()
+        self.jobs = collections.OrderedDict()
+        self.job_ids = itertools.count()
+        self.submissions = Queue.Queue()
+        self.finished_jobs = []
+        self.exit_when_idle = False
+        self.stopping = False
+
+    def status(self):
+        status = super(JobServer, self).status()
+        status['jobs'] = [dict(job.taskmanager.status(), id=job.id) for job in self.jobs.values()]
+        return status
+
+    def submit(self, job):
+        job.id = next(self.job_ids)
+        self.submissions.put(job)
+        return job
+
+    def stop(self):
+        self.stopping = True
+
+    def get_results(self):
+        return self.finished_jobs
+
+    def tick(self):
+        while True:
+            try:
+                job = self.submissions.get_nowait()
+            except Queue.Empty:
+                break
+            logging.info("Starting job %d" % job.id)
+            job.job_setup = get_job_setup(job)
+            self.jobs[job.id] = job
+            self.wake_idle()
+        idle = self.exit_when_idle and not self.jobs and self.submissions.empty()
+        if self.accepting and (self.stopping or idle):
+            self.disconnect_all()
+            self.handle_close()
+            return
+        super(JobServer, self).tick()
+
+    def next_task(self, channel):
+        if not channel.options.get('jobs'):
+            return (None, None)
+        # Between equally busy jobs, one this worker is already set up for
+        # saves sending it another job's functions and side data
+        for job in sorted(self.jobs.values(), key=lambda job: (job.tasks_in_flight, job.id not in channel.jobs)):
+            command, data = job.taskmanager.next_task(channel)
+            if command in (None, 'disconnect'):
+                continue
+            if job.id not in channel.jobs:
+                channel.send_job_setup(job.job_setup, job.id)
+                channel.jobs.add(job.id)
+            job.tasks_in_flight += 1
+            channel.job_tasks[job.id] += 1
+            return ('job', (job.id, command, data))
+        return (None, None)
+
+    def channel_lost(self, channel):
+        return any([job.taskmanager.channel_lost(channel) for job in self.jobs.values()])
+
+    def backlogged(self):
+        return any(job.taskmanager.backlogged() for job in self.jobs.values())
+
+    def overdue_channels(self, timeout, now):
+        return set().union(*[job.taskmanager.overdue_channels(timeout, now) for job in self.jobs.values()])
+
+    def holders_changed(self, tags):
+        for job in self.jobs.values():
+            job.taskmanager.holders_changed(tags)
+
+    def finish_job(self, job):
+        if job.id not in self.jobs:
+            return
+        logging.info("Finished job %d" % job.id)
+        if job.profile_path:
+            write_profile(job.profile_path, dict(job.taskmanager.status(), id=job.id))
+        del self.jobs[job.id]
+        self.finished_jobs.append(job)
+        for channel in self.channels:
+            if job.id in channel.jobs:
+                channel.send_command('endjob', job.id)
+                channel.jobs.discard(job.id)
+                # The worker drops the job's tasks without replying
+                channel.tasks_in_flight -= channel.job_tasks.pop(job.id, 0)
+                self.idle_channels.add(channel)
+        job.finished.set()
+
 class SqliteTaskManager(TaskManager):
+    """Keeps map output and results in a SQLite database.
+
+    For the reduce phase, map output is grouped by an external sort on the
+    key's JSON text, holding at most server.sort_buffer_size values in
+    memory at a time. Values are never unpickled on the server: they go out
+    to the workers as they were stored.
+
+    Map output rows are tagged with the map task that produced them, and
+    every datasource key of a task is recorded as done once its output is
+    saved. A resumed job drops the output of tasks that weren't finished,
+    maps only the keys that aren't done and, if it was reducing, reduces
+    only the keys without a result yet.
+    """
     INITIAL_SQL = "initial.sql"
+    REDUCE_COMMAND = 'reduceraw'
 
     @property
     def state(self):
@@ -402,15 +1681,26 @@ class SqliteTaskManager(TaskManager):
 
     @state.setter
     def state(self, new_state):
-        self.cursor.execute("update state set current_state = :state", (new_state,))
+        # A resumed job carries on from the state it was saved in
+        if self.resuming and new_state == TaskManager.START:
+            return
+        self.execute("update state set current_state = :state", (new_state,))
         self._state = new_state
 
     def __init__(self, datasource, server):
         self.db = server.db
+        self.writer = server.writer
+        # rows inserted since the last commit
+        self.uncommitted = 0
+        self.resuming = server.resume
+        # JSON keys already reduced before resuming
+        self.reduced = set()
         
         if not server.resume:
             # load initial schema
             self.cursor = self.db.cursor()
+            if self.writer:
+                self.writer.flush()
 
             schema = open(os.path.join(os.path.dirname(__file__), self.INITIAL_SQL)).read()
             self.cursor.executescript(schema)
@@ -418,45 +1708,111 @@ class SqliteTaskManager(TaskManager):
             super(SqliteTaskManager, self).__init__(datasource, server)
         else:
             self.cursor = self.db.cursor()
-            
-            super(SqliteTaskManager, self).__init__(datasource, server)
-            
+
+            # Read before the base class sets up its own state
             old_state = list(self.cursor.execute("select * from state"))
             if old_state:
                 self._state = old_state[0][0]
             else:
                 raise Exception("No state found; resumption failed.")
 
-    def save_map_results(self, mkey, results):
+            super(SqliteTaskManager, self).__init__(datasource, server)
+
+    def execute(self, sql, params=(), many=False):
+        if self.writer:
+            self.writer.put(sql, params, many)
+            return
+        if many:
+            self.cursor.executemany(sql, params)
+        else:
+            self.cursor.execute(sql, params)
+        # Commit every server.commit_rows rows rather than every statement
+        self.uncommitted += self.cursor.rowcount
+        if self.uncommitted >= self.server.commit_rows:
+            self.commit()
+
+    def commit(self):
+        if self.writer:
+            self.writer.flush()
+        else:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def map_result_rows(self, results, *extra):
         for (rkey, values) in results:
             json_key = json.dumps(rkey)
             for value in values:
-                self.cursor.execute("insert into map_results (key, value) values (:key, :data)", (json_key, sqlite3.Binary(pickle.dumps(value, -1))))
+                yield (json_key, sqlite3.Binary(pickle.dumps(value, -1))) + extra
+
+    def next_task(self, channel):
+        if self.resuming:
+            self.resume()
+        return super(SqliteTaskManager, self).next_task(channel)
+
+    def backlogged(self):
+        return bool(self.writer) and self.writer.queue.qsize() >= self.writer.queue.maxsize // 2
+
+    def status(self):
+        status = super(SqliteTaskManager, self).status()
+        if self.writer:
+            status['write_queue'] = self.writer.queue.qsize()
+        return status
+
+    def resume(self):
+        self.resuming = False
+        if self.state == TaskManager.START:
+            # Stopped before it was known to be mapping, so nothing saved
+            # can be told apart from a task that didn't finish
+            self.execute("delete from map_results")
+            self.execute("delete from map_tasks")
+            self.execute("delete from reduce_results")
+            self.commit()
+            return
+        if self.state not in (TaskManager.MAPPING, TaskManager.REDUCING):
+            return
+        self.execute("delete from map_results where task is not null and task not in (select task from map_tasks)")
+        self.commit()
+        self.start()
+        done = set(pickle.loads(str(row[0])) for row in self.db.execute("select key from map_tasks"))
+        self.map_iter = (key for key in self.map_iter if key not in done)
+        logging.info("Resuming with %d datasource keys mapped" % len(done))
+        if self.state == TaskManager.REDUCING:
+            self.reduced = set(row[0] for row in self.db.execute("select key from reduce_results"))
+            logging.info("Resuming with %d keys reduced" % len(self.reduced))
+            self.reduce_iter = self.get_reduce_iter()
+
+    def save_map_task(self, map_item, results):
+        keys = [key for key, value in map_item[1]] if self.batching else [map_item[0]]
+        # A task is known by its first datasource key, which no other task has
+        task = sqlite3.Binary(pickle.dumps(keys[0], -1))
+        self.save_map_results(map_item[0], results.iteritems(), task=task)
+        self.execute("insert or replace into map_tasks (key, task) values (:key, :task)",
+                     [(sqlite3.Binary(pickle.dumps(key, -1)), task) for key in keys], many=True)
+
+    def save_map_results(self, mkey, results, task=None):
+        self.execute("insert into map_results (key, value, task) values (:key, :data, :task)", self.map_result_rows(results, task), many=True)
    
     def _get_reduce_results(self):
-        self.db.commit()
+        self.commit()
 
         # use a dedicated cursor for this so it doesn't get trampled by reduce saves
         cursor = self.db.cursor()
-        return cursor.execute("select key, value from map_results order by key asc")
+        return cursor.execute("select key, value from map_results")
 
     def get_reduce_iter(self):
-        map_results = self._get_reduce_results()
-        groups = itertools.groupby(
-            itertools.imap(
-                lambda row: (tuple(json.loads(row[0])), pickle.loads(str(row[1]))),
-                map_results
-            ),
-            key = lambda d: d[0]
-        )
-        return itertools.imap(lambda group: (group[0], map(lambda record: record[1], group[1])), groups)
+        sorter = Combiner(spill_size=self.server.sort_buffer_size)
+        for json_key, value in self._get_reduce_results():
+            sorter.add(json_key, str(value))
+        for json_key, values in sorter.iter_groups(ordered=True):
+            if json_key not in self.reduced:
+                yield tuple(json.loads(json_key)), values
 
     def save_reduce_results(self, rkey, result):
         json_key = json.dumps(rkey)
-        self.cursor.execute("insert into reduce_results (key, value) values (:key, :data)", (json_key, sqlite3.Binary(pickle.dumps(result, -1))))
+        self.execute("insert or replace into reduce_results (key, value) values (:key, :data)", (json_key, sqlite3.Binary(pickle.dumps(result, -1))))
 
     def get_results(self):
-        self.db.commit()
+        self.commit()
 
         cursor = self.db.cursor()
         reduce_results = cursor.execute("select key, value from reduce_results order by key asc")
@@ -466,25 +1822,51 @@ class SqliteTaskManager(TaskManager):
         )
 
 class BatchSqliteTaskManager(SqliteTaskManager):
+    """Reduces each key's values in slices of at most server.batch_size,
+    then reduces the slices' results together until one is left.
+
+    By default this goes in rounds: the partial results of a round are
+    saved as map output one depth down, and the next round starts once
+    every key of the current one is done. If the reducefn is marked
+    associative, the partial results are instead kept in memory and
+    combined into a tree, server.reduce_fan_in at a time, as soon as that
+    many for a key are in.
+    """
     INITIAL_SQL = "initial_batch.sql"
+    REDUCE_COMMAND = 'partialreduceraw'
 
     def __init__(self, datasource, server):
         super(BatchSqliteTaskManager, self).__init__(datasource, server)
         self.multiple_slices = set()
         self.depth = 0
+        # Tree reduction: per key, partial results waiting to be combined
+        # and the number of its tasks still running
+        self.partials = {}
+        self.running = collections.Counter()
+        self.sliced = set()
+        self.combines = itertools.count()
 
-    def save_map_results(self, mkey, results, depth=0):
-        for (rkey, values) in results:
-            json_key = json.dumps(rkey)
-            for value in values:
-                self.cursor.execute("insert into map_results (key, value, depth) values (:key, :data, :depth)", (json_key, sqlite3.Binary(pickle.dumps(value, -1)), depth))
+    @property
+    def tree_reduce(self):
+        return bool(self.server.reduce_fan_in) and getattr(self.server.reducefn, 'associative', False)
+
+    def save_map_results(self, mkey, results, depth=0, task=None):
+        self.execute("insert into map_results (key, value, task, depth) values (:key, :data, :task, :depth)", self.map_result_rows(results, task, depth), many=True)
+
+    def resume(self):
+        # Partial results aren't tied to the slices they came from, so the
+        # reduce phase starts over
+        if self.state == TaskManager.REDUCING:
+            self.execute("delete from map_results where depth > 0")
+            self.execute("delete from reduce_results")
+        super(BatchSqliteTaskManager, self).resume()
 
     def _get_reduce_results(self):
-        self.db.commit()
+        self.commit()
 
         # use a dedicated cursor for this so it doesn't get trampled by reduce saves
         cursor = self.db.cursor()
-        return cursor.execute("select key, value from map_results where depth = :depth order by depth, key asc", (self.depth,))
+        return cursor.execute("select key, value from map_results where depth = :depth", (self.depth,))
 
     def get_reduce_iter(self):        
         def batched_iter():
@@ -497,7 +1879,13 @@ class BatchSqliteTaskManager(SqliteTaskManager):
                     if out:
                         slice_count += 1
 
-                        if hn_records.hasnext():
+                        if self.tree_reduce:
+                            # combine() needs each key's slices out, and
+                            # whether its last slice has been cut
+                            self.running[key] += 1
+                            if not hn_records.hasnext():
+                                self.sliced.add(key)
+                        elif hn_records.hasnext():
                             # this slice didn't consume the whole group, so flag it
                             self.multiple_slices.add(key)
 
@@ -507,27 +1895,47 @@ class BatchSqliteTaskManager(SqliteTaskManager):
 
         return batched_iter()
 
-    def reduce_done(self, data):
+    def reduce_done(self, data, channel=None):
         # Don't use the results if they've already been counted
         if not data[0] in self.working_reduces:
             return
 
-        if data[0][0] in self.multiple_slices:
+        if self.tree_reduce:
+            self.combine(data[0], data[1])
+        elif data[0][0] in self.multiple_slices:
             self.save_map_results(data[0], [(data[0][0], [data[1]])], depth=self.depth+1)
         else:
             self.save_reduce_results(data[0][0], data[1])
         del self.working_reduces[data[0]]
+        self.task_finished(self.reduce_timer, data[0], channel)
+
+    def combine(self, task_key, result):
+        key = task_key[0]
+        self.running[key] -= 1
+        partials = self.partials.setdefault(key, [])
+        partials.append(result)
+        finished = key in self.sliced and not self.running[key]
+        if finished and len(partials) == 1:
+            self.save_reduce_results(key, result)
+            del self.partials[key], self.running[key]
+            self.sliced.discard(key)
+        elif len(partials) >= self.server.reduce_fan_in or (finished and len(partials) > 1):
+            fan_in, self.partials[key] = partials[:self.server.reduce_fan_in], partials[self.server.reduce_fan_in:]
+            self.running[key] += 1
+            self.ready.append(((key, "c%d" % next(self.combines), task_key[2] + 1),
+                               [pickle.dumps(partial, -1) for partial in fan_in]))
 
     def next_task(self, channel):
+        if self.resuming:
+            self.resume()
         if self.state == TaskManager.REDUCING:
+            if self.ready:
+                return self.issue_reduce(self.ready.popleft(), channel)
             try:
-                reduce_item = self.reduce_iter.next()
-                self.working_reduces[reduce_item[0]] = reduce_item[1]
-                return ('partialreduce', reduce_item)
+                return self.issue_reduce(self.reduce_iter.next(), channel)
             except StopIteration:
                 if len(self.working_reduces) > 0:
-                    key = random.choice(self.working_reduces.keys())
-                    return ('partialreduce', (key, self.working_reduces[key]))
+                    return self.speculative_task(self.working_reduces, self.reduce_timer, self.REDUCE_COMMAND, channel)
                 # we might actually be done, but we might also have to repeat the reduce round
                 if self.multiple_slices:
                     # at least one key needs another reduction round
@@ -539,20 +1947,850 @@ class BatchSqliteTaskManager(SqliteTaskManager):
                     self.state = TaskManager.FINISHED
         return super(BatchSqliteTaskManager, self).next_task(channel)
 
+class SqliteWriter(threading.Thread):
+    """Applies queued writes on a connection of its own, committing every
+    commit_rows rows, so that a slow disk doesn't hold up the asyncore loop.
+
+    At most queue_size statements wait in the queue; beyond that, put()
+    blocks. A failed write is raised from the next put() or flush().
+    """
+
+    def __init__(self, db_path, pragmas, commit_rows, queue_size):
+        threading.Thread.__init__(self, name="mincemeat-sqlite-writer")
+        self.daemon = True
+        self.db_path = db_path
+        self.pragmas = pragmas
+        self.commit_rows = commit_rows
+        self.queue = Queue.Queue(queue_size)
+        self.error = None
+
+    def run(self):
+        db = sqlite3.connect(self.db_path)
+        for name, value in self.pragmas.items():
+            db.execute("pragma %s = %s" % (name, value))
+        cursor = db.cursor()
+        uncommitted = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                db.commit()
+                db.close()
+                self.queue.task_done()
+                return
+            sql, params, many = item
+            try:
+                if sql is None:
+                    db.commit()
+                    uncommitted = 0
+                else:
+                    if many:
+                        cursor.executemany(sql, params)
+                    else:
+                        cursor.execute(sql, params)
+                    uncommitted += cursor.rowcount
+                    if uncommitted >= self.commit_rows:
+                        db.commit()
+                        uncommitted = 0
+            except Exception, e:
+                logging.exception("SQLite write failed")
+                self.error = self.error or e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def put(self, sql, params=(), many=False):
+        self.check()
+        self.queue.put((sql, params, many))
+
+    def flush(self):
+        """Commits everything queued so far and waits for it to land."""
+        self.queue.put((None, None, False))
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        self.check()
+
 class SqliteServer(Server):
     taskmanager_cls = SqliteTaskManager
+    # Applied to the connection unless other pragmas are passed in
+    DEFAULT_PRAGMAS = {'journal_mode': 'wal', 'synchronous': 'normal'}
 
-    def __init__(self, db_path, resume=False):
+    def __init__(self, db_path, resume=False, pragmas=None, commit_rows=10000,
+                 background_writes=True, write_queue_size=1000, sort_buffer_size=1000000):
         self.db = sqlite3.connect(db_path)
+        if pragmas is None:
+            pragmas = self.DEFAULT_PRAGMAS
+        # Writes go through a SqliteWriter thread unless the database only
+        # exists inside this connection
+        background_writes = background_writes and db_path != ":memory:"
+        if background_writes:
+            # Reads on self.db overlap the writer's commits, which needs WAL
+            pragmas = dict(pragmas, journal_mode='wal')
+        for name, value in pragmas.items():
+            self.db.execute("pragma %s = %s" % (name, value))
+        self.writer = None
+        if background_writes:
+            self.writer = SqliteWriter(db_path, pragmas, commit_rows, write_queue_size)
+            self.writer.start()
         self.resume = resume
+        self.commit_rows = commit_rows
+        self.sort_buffer_size = sort_buffer_size
         super(SqliteServer, self).__init__()
 
+    def run_server(self, *args, **kwargs):
+        try:
+            return super(SqliteServer, self).run_server(*args, **kwargs)
+        finally:
+            if self.writer:
+                self.writer.close()
+
 class BatchSqliteServer(SqliteServer):
     taskmanager_cls = BatchSqliteTaskManager
 
-    def __init__(self, db_path, batch_size, resume=False):
+    def __init__(self, db_path, batch_size, resume=False, reduce_fan_in=8, **kwargs):
         self.batch_size = batch_size
-        super(BatchSqliteServer, self).__init__(db_path, resume)
+        self.reduce_fan_in = reduce_fan_in
+        super(BatchSqliteServer, self).__init__(db_path, resume, **kwargs)
+
+Run = collections.namedtuple('Run', 'path offset count level')
+
+class PartitionedTaskManager(TaskManager):
+    """Shuffles map output into server.partitions partitions by key hash.
+
+    Each partition buffers at most server.spill_size values in memory before
+    they are written out, sorted by key, as a run appended to the
+    partition's spill file. While maps are still running, every
+    server.merge_fan_in runs of a size are merged into one bigger run, so
+    the reduce phase has few runs to merge and groups stream off disk in key
+    order.
+
+    With server.reduce_early set, reducing starts as soon as every map task
+    has been handed out, using the map output saved so far. Map output that
+    arrives later for an already reduced key is reduced again together with
+    that key's result, so reducefn has to accept its own output among its
+    values, as with BatchSqliteServer.
+    """
+
+    def __init__(self, datasource, server):
+        super(PartitionedTaskManager, self).__init__(datasource, server)
+        self.partitions = server.partitions
+        self.spill_size = server.spill_size
+        self.merge_fan_in = server.merge_fan_in
+        self.spill_dir = server.spill_dir
+        self.own_spill_dir = False
+        self.buffers = [{} for i in xrange(self.partitions)]
+        self.buffered = [0] * self.partitions
+        self.runs = [[] for i in xrange(self.partitions)]
+        self.merges = itertools.count()
+        # Early reducing: each partition's runs from before it started are
+        # frozen, and those after it are the deltas
+        self.early_groups = None
+        self.frozen = [0] * self.partitions
+        self.early_partitions = set()
+        self.deferred = {}
+        # Task keys of the reduces that fold deltas into an early result, by
+        # the key they reduce
+        self.rereduces = {}
+        self.rereduce_ids = itertools.count()
+
+    def partition(self, key):
+        return hash(key) % self.partitions
+
+    def partition_path(self, partition, suffix=""):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="mincemeat-")
+            self.own_spill_dir = True
+        return os.path.join(self.spill_dir, "partition-%05d%s" % (partition, suffix))
+
+    def save_map_results(self, mkey, results):
+        for (key, values) in results:
+            partition = self.partition(key)
+            buf = self.buffers[partition]
+            if key not in buf:
+                buf[key] = []
+            buf[key].extend(values)
+            self.buffered[partition] += len(values)
+            if self.buffered[partition] >= self.spill_size:
+                self.spill(partition)
+
+    def spill(self, partition):
+        buf = self.buffers[partition]
+        if not buf:
+            return
+        path = self.partition_path(partition)
+        with open(path, "ab") as f:
+            offset, count = write_run(f, ((key, buf[key]) for key in sorted(buf)))
+        self.runs[partition].append(Run(path, offset, count, 0))
+        self.buffers[partition] = {}
+        self.buffered[partition] = 0
+        self.compact(partition)
+
+    def compact(self, partition):
+        # Runs are only ever appended and merged from the end, so their levels
+        # never increase along the list and the last merge_fan_in runs are
+        # the ones to merge. Frozen runs are left alone.
+        runs = self.runs[partition]
+        while len(runs) - self.frozen[partition] >= self.merge_fan_in:
+            tail = runs[-self.merge_fan_in:]
+            if any(run.level != tail[-1].level for run in tail):
+                break
+            path = self.partition_path(partition, ".%d" % next(self.merges))
+            with open(path, "wb") as f:
+                offset, count = write_run(f, self.iter_runs(tail))
+            runs[-self.merge_fan_in:] = [Run(path, offset, count, tail[-1].level + 1)]
+            self.remove_unused(partition, tail)
+
+    def remove_unused(self, partition, old_runs):
+        in_use = set(run.path for run in self.runs[partition])
+        for path in set(run.path for run in old_runs) - in_use:
+            os.remove(path)
+
+    def iter_runs(self, runs):
+        files = dict((path, open(path, "rb")) for path in set(run.path for run in runs))
+        try:
+            for group in merge_runs([(files[run.path], run.offset, run.count) for run in runs]):
+                yield group
+        finally:
+            for f in files.values():
+                f.close()
+
+    def map_tail_task(self, channel):
+        if self.server.reduce_early:
+            if self.early_groups is None:
+                logging.info("Reducing early")
+                self.early_groups = self.iter_early()
+            for reduce_item in self.early_groups:
+                return self.issue_reduce(reduce_item, channel)
+        return super(PartitionedTaskManager, self).map_tail_task(channel)
+
+    def iter_early(self):
+        for partition in xrange(self.partitions):
+            self.spill(partition)
+            self.frozen[partition] = len(self.runs[partition])
+        for partition in xrange(self.partitions):
+            self.early_partitions.add(partition)
+            for group in self.iter_runs(self.runs[partition][:self.frozen[partition]]):
+                yield group
+
+    def rereduce(self, key, values):
+        # Its own task key, so a late copy of the key's early reduce isn't
+        # taken for this one
+        task_key = (key, "r%d" % next(self.rereduce_ids))
+        self.rereduces[task_key] = key
+        return task_key, [self.results[key]] + values
+
+    def reduce_command(self, key):
+        if key in self.rereduces:
+            return 'partialreduce'
+        return super(PartitionedTaskManager, self).reduce_command(key)
+
+    def reduce_done(self, data, channel=None):
+        super(PartitionedTaskManager, self).reduce_done(data, channel)
+        if data[0] in self.deferred and data[0] not in self.working_reduces:
+            self.ready.append(self.rereduce(data[0], self.deferred.pop(data[0])))
+
+    def save_reduce_results(self, key, result):
+        super(PartitionedTaskManager, self).save_reduce_results(self.rereduces.pop(key, key), result)
+
+    def get_reduce_iter(self):
+        for partition in xrange(self.partitions):
+            self.spill(partition)
+        if self.early_groups is not None:
+            # finish the early pass before its partitions' deltas come up
+            for group in self.early_groups:
+                yield group
+        for partition in xrange(self.partitions):
+            runs = self.runs[partition]
+            if partition not in self.early_partitions:
+                for group in self.iter_runs(runs):
+                    yield group
+            else:
+                for key, values in self.iter_runs(runs[self.frozen[partition]:]):
+                    if key in self.working_reduces:
+                        # wait for the early result to reduce alongside
+                        self.deferred[key] = values
+                        continue
+                    if key in self.results:
+                        yield self.rereduce(key, values)
+                    else:
+                        yield key, values
+            self.runs[partition] = []
+            self.remove_unused(partition, runs)
+        if self.own_spill_dir:
+            os.rmdir(self.spill_dir)
+
+class PartitionedServer(Server):
+    taskmanager_cls = PartitionedTaskManager
+
+    def __init__(self, partitions=16, spill_dir=None, spill_size=100000,
+                 merge_fan_in=8, reduce_early=False):
+        self.partitions = partitions
+        self.spill_dir = spill_dir
+        self.spill_size = spill_size
+        self.merge_fan_in = merge_fan_in
+        self.reduce_early = reduce_early
+        super(PartitionedServer, self).__init__()
+
+class InputSplit(object):
+    """A byte range of a file, read by the worker that maps it.
+
+    With line_aligned set, a split skips the partial line it starts in
+    (unless it starts at the top of the file) and runs on through the end of
+    the line that crosses its end, so every line is read by exactly one
+    split.
+    """
+
+    def __init__(self, path, start, length, line_aligned=True):
+        self.path = path
+        self.start = start
+        self.length = length
+        self.line_aligned = line_aligned
+
+    def __repr__(self):
+        return "InputSplit(%r, %d, %d)" % (self.path, self.start, self.length)
+
+    def read(self):
+        end = self.start + self.length
+        with open(self.path, "rb") as f:
+            if not self.line_aligned:
+                f.seek(self.start)
+                return f.read(self.length)
+            if self.start:
+                f.seek(self.start - 1)
+                f.readline()
+            data = f.read(max(0, end - f.tell()))
+            if data and not data.endswith("\n"):
+                data += f.readline()
+            return data
+
+class SplitDatasource(object):
+    """Dictionary-like datasource that cuts files into InputSplits of at most
+    split_size bytes. The server only hands out the split descriptors; each
+    worker reads its own range.
+
+    paths is a path or a list of them, each a file, a directory (taking
+    every file below it) or a glob pattern.
+    """
+
+    def __init__(self, paths, split_size=64 << 20, line_aligned=True):
+        if isinstance(paths, basestring):
+            paths = [paths]
+        self.splits = collections.OrderedDict()
+        for path in expand_paths(paths):
+            size = os.path.getsize(path)
+            for start in xrange(0, size, split_size):
+                key = "%s:%d" % (path, start)
+                self.splits[key] = InputSplit(path, start, min(split_size, size - start), line_aligned)
+
+    def __iter__(self):
+        return iter(self.splits)
+
+    def __len__(self):
+        return len(self.splits)
+
+    def __getitem__(self, key):
+        return self.splits[key]
+
+    def locality(self, key, split):
+        # Workers started with --local advertise absolute paths
+        return [os.path.abspath(split.path)]
+
+def expand_paths(paths):
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)):
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(files):
+                        yield os.path.join(root, name)
+            else:
+                yield path
+
+class LocalityQueue(object):
+    """Datasource keys waiting to be mapped, queued under each locality tag
+    of the data they need (untagged keys under None).
+
+    A worker is handed keys whose data it holds while there are any, then
+    keys whose data no connected worker holds, and only then data that is
+    local to another worker.
+    """
+
+    def __init__(self, keys, tags, holders):
+        # holders counts the connected workers holding each tag
+        self.holders = holders
+        # Queues of the tags no connected worker holds, and of the rest
+        self.orphaned = collections.OrderedDict()
+        self.held = collections.OrderedDict()
+        self.taken = set()
+        for key in keys:
+            for tag in tags(key) or [None]:
+                queues = self.queues(tag)
+                if tag not in queues:
+                    queues[tag] = collections.deque()
+                queues[tag].append(key)
+
+    def queues(self, tag):
+        return self.held if self.holders[tag] > 0 else self.orphaned
+
+    def holders_changed(self, tags):
+        """Moves the queues of tags whose count in holders has changed
+        between orphaned and held."""
+        for tag in tags:
+            source = self.held if tag in self.held else self.orphaned
+            target = self.queues(tag)
+            if source is not target and tag in source:
+                target[tag] = source.pop(tag)
+
+    def pop(self, held):
+        """Returns the next key for a worker holding the tags in held, and
+        whether its data is local to it."""
+        for tag in held:
+            key = self.pop_tag(tag)
+            if key is not None:
+                return key, True
+        for queues in (self.orphaned, self.held):
+            while queues:
+                key = self.pop_tag(next(iter(queues)))
+                if key is not None:
+                    return key, False
+        raise StopIteration
+
+    def pop_tag(self, tag):
+        queues = self.queues(tag)
+        queue = queues.get(tag)
+        while queue:
+            key = queue.popleft()
+            # Keys with several tags sit in several queues
+            if key not in self.taken:
+                self.taken.add(key)
+                return key
+        queues.pop(tag, None)
+        return None
+
+class MapCache(object):
+    """Map task output kept in a directory from one run to the next.
+
+    Output is filed under a digest of the mapfn, collectfn and side data,
+    and of each of the task's datasource keys and values. InputSplits count
+    as their file's path, size and modification time rather than their
+    contents. Once the files take more than max_bytes, the least recently
+    used ones are removed.
+    """
+
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+        files = []
+        for name in os.listdir(path):
+            if name.endswith(".tmp"):
+                continue
+            st = os.stat(os.path.join(path, name))
+            files.append((st.st_mtime, name, st.st_size))
+        for mtime, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+
+    def task_digest(self, code_digest, items):
+        digest = hashlib.sha1(code_digest)
+        for key, value in items:
+            digest.update(pickle.dumps(key, -1))
+            if isinstance(value, InputSplit):
+                st = os.stat(value.path)
+                value = (value.path, value.start, value.length, value.line_aligned, st.st_size, st.st_mtime)
+            digest.update(hashlib.sha1(pickle.dumps(value, -1)).digest())
+        return digest.hexdigest()
+
+    def get(self, digest):
+        if digest not in self.entries:
+            self.misses += 1
+            return None
+        path = os.path.join(self.path, digest)
+        with open(path, "rb") as f:
+            results = pickle.load(f)
+        # Mark it as recently used for the next run too
+        os.utime(path, None)
+        self.entries[digest] = self.entries.pop(digest)
+        self.hits += 1
+        return results
+
+    def put(self, digest, results):
+        path = os.path.join(self.path, digest)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(results, f, -1)
+            size = f.tell()
+        os.rename(path + ".tmp", path)
+        self.size += size - self.entries.pop(digest, 0)
+        self.entries[digest] = size
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            os.remove(os.path.join(self.path, name))
+            self.size -= size
+
+class EpollPoller(object):
+    """Waits on asyncore's sockets with epoll, which isn't bound by select's
+    FD_SETSIZE limit on descriptors. Each socket's readable() and
+    writable() are still asked on every poll, but the kernel is only told
+    (by epoll_ctl) about sockets whose interest changed, rather than being
+    handed every socket again as select and poll are."""
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        # (dispatcher, event mask) by file descriptor
+        self.registered = {}
+
+    def poll(self, timeout, socket_map):
+        # A closed socket's descriptor may have been reused by a new one
+        for fd, (obj, flags) in self.registered.items():
+            if socket_map.get(fd) is not obj:
+                self.unregister(fd)
+        for fd, obj in socket_map.items():
+            flags = 0
+            if obj.readable():
+                flags |= select.EPOLLIN | select.EPOLLPRI
+            if obj.writable() and not obj.accepting:
+                flags |= select.EPOLLOUT
+            if flags:
+                flags |= select.EPOLLERR | select.EPOLLHUP
+            registered = self.registered.get(fd)
+            if registered and registered[1] == flags:
+                continue
+            if not flags:
+                self.unregister(fd)
+                continue
+            if registered:
+                self.epoll.modify(fd, flags)
+            else:
+                self.epoll.register(fd, flags)
+            self.registered[fd] = (obj, flags)
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, e:
+            if e.errno != errno.EINTR:
+                raise
+            return
+        for fd, flags in events:
+            obj = socket_map.get(fd)
+            if obj is not None:
+                # The epoll event bits are the same as poll's
+                asyncore.readwrite(obj, flags)
+
+    def unregister(self, fd):
+        if self.registered.pop(fd, None):
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError):
+                # Already dropped by the kernel when the socket closed
+                pass
+
+def make_poller():
+    """Returns the most scalable poll(timeout, socket_map) for asyncore's
+    sockets on this platform."""
+    if hasattr(select, 'epoll'):
+        return EpollPoller().poll
+    if hasattr(select, 'poll'):
+        return asyncore.poll2
+    return asyncore.poll
+
+class StatusServer(asyncore.dispatcher):
+    """Answers every HTTP request on address with the server's status() as
+    JSON."""
+
+    def __init__(self, server, address):
+        asyncore.dispatcher.__init__(self)
+        self.server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(5)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair:
+            StatusChannel(pair[0], self.server)
+
+class StatusChannel(asynchat.async_chat):
+    def __init__(self, conn, server):
+        asynchat.async_chat.__init__(self, conn)
+        self.server = server
+        self.set_terminator("\r\n\r\n")
+
+    def collect_incoming_data(self, data):
+        pass
+
+    def found_terminator(self):
+        body = json.dumps(self.server.status(), indent=2, sort_keys=True, default=repr)
+        self.push("HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(body))
+        self.push(body)
+        self.close_when_done()
+
+def write_profile(path, status):
+    with open(path, "w") as f:
+        json.dump(status, f, indent=2, sort_keys=True, default=repr)
+
+def write_run(f, groups):
+    """Appends (key, values) groups, which must come in key order, to f as a
+    run, returning the run's (offset, record count)."""
+    f.seek(0, os.SEEK_END)
+    offset = f.tell()
+    count = 0
+    for group in groups:
+        pickle.dump(group, f, -1)
+        count += 1
+    return offset, count
+
+def read_run(f, offset, count, run_id):
+    # Several runs are read from the same file at once, so each one tracks
+    # its own position.
+    position = offset
+    for i in xrange(count):
+        f.seek(position)
+        key, values = pickle.load(f)
+        position = f.tell()
+        # run_id breaks ties between runs without comparing values
+        yield key, run_id, values
+
+def merge_runs(runs):
+    """Merges runs written by write_run, given as (file, offset, record
+    count), yielding each key once along with all of its values."""
+    runs = [read_run(f, offset, count, run_id) for run_id, (f, offset, count) in enumerate(runs)]
+    for key, group in itertools.groupby(heapq.merge(*runs), key=lambda record: record[0]):
+        values = []
+        for record in group:
+            values.extend(record[2])
+        yield key, values
+
+class Combiner(object):
+    """Groups the (key, value) pairs emitted by a mapfn.
+
+    With combine_size set, a key's values are folded together with
+    collectfn every time combine_size of them have piled up, which requires
+    collectfn to accept its own output among its inputs. With spill_size
+    set, once that many values are held they are written to a temporary
+    file as a sorted run, and the runs are merged back when the results are
+    collected. Without either, this behaves like grouping everything in a
+    dict and applying collectfn once per key at the end.
+    """
+
+    def __init__(self, collectfn=None, combine_size=None, spill_size=None):
+        self.collectfn = collectfn
+        self.combine_size = combine_size if collectfn else None
+        self.spill_size = spill_size
+        self.groups = {}
+        self.held = 0
+        self.spill_file = None
+        self.runs = []
+
+    def add(self, key, value):
+        values = self.groups.get(key)
+        if values is None:
+            values = self.groups[key] = []
+        values.append(value)
+        self.held += 1
+        if self.combine_size and len(values) >= self.combine_size:
+            self.groups[key] = [self.collectfn(key, values)]
+            self.held -= len(values) - 1
+        if self.spill_size and self.held >= self.spill_size:
+            self.spill()
+
+    def spill(self):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile()
+        self.runs.append(write_run(self.spill_file, ((key, self.groups[key]) for key in sorted(self.groups))))
+        self.groups = {}
+        self.held = 0
+
+    def iter_groups(self, ordered=False):
+        """Yields each key once with all of its values, in key order if
+        ordered is set or anything was spilled."""
+        if self.runs:
+            self.spill()
+            groups = merge_runs([(self.spill_file, offset, count) for offset, count in self.runs])
+        elif ordered:
+            groups = ((key, self.groups[key]) for key in sorted(self.groups))
+        else:
+            groups = self.groups.iteritems()
+        try:
+            for group in groups:
+                yield group
+        finally:
+            if self.spill_file:
+                self.spill_file.close()
+
+    def results(self):
+        results = {}
+        for key, values in self.iter_groups():
+            if self.collectfn:
+                values = [self.collectfn(key, values)]
+            results[key] = values
+        return results
+
+def associative(reducefn):
+    """Marks reducefn as safe to apply to its own results in any grouping,
+    so that BatchSqliteServer can reduce a key's slices as a tree."""
+    reducefn.associative = True
+    return reducefn
+
+def get_job_setup(job):
+    """Returns the (command, name, digest, data) sent to set up each worker
+    for a Server's or Job's job, digest being what workers cache the data
+    under."""
+    setup = []
+    for name in ('mapfn', 'reducefn', 'collectfn'):
+        function = getattr(job, name)
+        if function:
+            code = marshal.dumps(function.func_code)
+            setup.append((name, name, hashlib.sha1(code).hexdigest(), code))
+    if job.columnar:
+        setup.append(('columnar', 'columnar', hashlib.sha1(job.columnar).hexdigest(), job.columnar))
+    for name, value in sorted(job.sidedata.items()):
+        pdata = pickle.dumps(value, -1)
+        digest = hashlib.sha1(pdata).hexdigest()
+        setup.append(('sidedata', name, digest, (name, digest, pdata)))
+    return setup
+
+def build_function(code, name):
+    return types.FunctionType(marshal.loads(code), globals(), name)
+
+def map_items(mapfn, collectfn, items, combine_size=None, spill_size=None):
+    combiner = Combiner(collectfn, combine_size, spill_size)
+    for map_key, value in items:
+        if isinstance(value, InputSplit):
+            value = value.read()
+        for k, v in mapfn(map_key, value):
+            combiner.add(k, v)
+    return combiner.results()
+
+# Operations a columnar map can aggregate each key's values with, as the
+# NumPy ufunc and the plain function
+COLUMN_OPS = {
+    'sum': ('add', operator.add),
+    'min': ('minimum', min),
+    'max': ('maximum', max),
+    }
+
+def map_columns(mapfn, items, op):
+    """Maps a batch with a columnar mapfn and aggregates its output by key,
+    returning the distinct keys and their aggregates as packed columns."""
+    keys = [map_key for map_key, value in items]
+    values = [value.read() if isinstance(value, InputSplit) else value for map_key, value in items]
+    out_keys, out_values = group_columns(mapfn(keys, values), op)
+    return pack_column(out_keys), pack_column(out_values)
+
+def group_columns(columns, op):
+    keys, values = columns
+    if numpy:
+        keys, values = numpy.asarray(keys), numpy.asarray(values)
+        if not len(keys):
+            return keys, values
+        order = numpy.argsort(keys, kind='mergesort')
+        keys, values = keys[order], values[order]
+        starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+        return keys[starts], getattr(numpy, COLUMN_OPS[op][0]).reduceat(values, starts)
+    combine = COLUMN_OPS[op][1]
+    totals = {}
+    for key, value in itertools.izip(keys, values):
+        totals[key] = combine(totals[key], value) if key in totals else value
+    return (array.array(column_typecode(keys), totals.iterkeys()),
+            array.array(column_typecode(values), totals.itervalues()))
+
+def column_typecode(column):
+    if isinstance(column, array.array):
+        return column.typecode
+    return 'd' if any(isinstance(value, float) for value in column) else 'l'
+
+def pack_column(column):
+    """Returns an array's typecode and raw bytes, which marshal sends as
+    they are. NumPy arrays go as the matching array module type, so that
+    the server doesn't need NumPy to read them."""
+    if isinstance(column, array.array):
+        return column.typecode, column.tostring()
+    column = numpy.ascontiguousarray(column)
+    code = column.dtype.char
+    if code not in 'bBhHiIlLfd' or array.array(code).itemsize != column.dtype.itemsize:
+        column = column.astype('d' if column.dtype.kind == 'f' else 'l')
+    if not column.dtype.isnative:
+        column = column.astype(column.dtype.newbyteorder('='))
+    return column.dtype.char, column.tostring()
+
+def columns_to_results(columns):
+    keys, values = [array.array(*column).tolist() for column in columns]
+    return dict((key, [value]) for key, value in itertools.izip(keys, values))
+
+# The job's functions as seen by this process: set by the Client as they
+# arrive, and rebuilt once at startup in each worker pool process.
+pool_functions = {}
+
+# The job's side data (Server.sidedata), by name
+sidedata = {}
+
+# Functions, as (code, function), and side data received by this worker,
+# by digest. Kept across jobs by --persistent workers, least recently used
+# first.
+job_cache = collections.OrderedDict()
+JOB_CACHE_SIZE = 32
+
+# Digests this worker has told the server it holds
+pinned_digests = set()
+
+def cache_job_item(digest, item):
+    job_cache.pop(digest, None)
+    job_cache[digest] = item
+    unpinned = [key for key in job_cache if key not in pinned_digests]
+    for key in unpinned[:max(len(job_cache) - JOB_CACHE_SIZE, 0)]:
+        del job_cache[key]
+
+def init_pool_worker(code, data):
+    # Drop our inherited copy of the server connection so that only the
+    # parent holds it open.
+    asyncore.close_all()
+    for name in code:
+        pool_functions[name] = build_function(code[name], name)
+    sidedata.update(data)
+
+def pool_map(items, combine_size=None, spill_size=None):
+    return map_items(pool_functions['mapfn'], pool_functions.get('collectfn'), items, combine_size, spill_size)
+
+def pool_map_columns(items, op):
+    return map_columns(pool_functions['mapfn'], items, op)
+
+def pool_reduce(key, values):
+    return pool_functions['reducefn'](key, values)
+
+def pool_reduce_raw(key, values):
+    return pool_functions['reducefn'](key, [pickle.loads(value) for value in values])
+
+def payload_size(value):
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, InputSplit):
+        return value.length
+    return len(pickle.dumps(value, -1))
+
+class PayloadProducer(object):
+    """asynchat producer that hands out a large string in buffer() slices,
+    so it goes out without being copied into chunks up front."""
+
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.offset = 0
+
+    def more(self):
+        chunk = buffer(self.data, self.offset, self.chunk_size)
+        self.offset += len(chunk)
+        return chunk
 
 # from http://stackoverflow.com/questions/1966591/hasnext-in-python-iterators
 class HNWrapper(object):
@@ -580,6 +2818,15 @@ def run_client():
     parser.add_option("-P", "--port", dest="port", type="int", default=DEFAULT_PORT, help="port")
     parser.add_option("-v", "--verbose", dest="verbose", action="store_true")
     parser.add_option("-V", "--loud", dest="loud", action="store_true")
+    parser.add_option("--prefetch", dest="prefetch", type="int", default=1, help="number of tasks to keep queued from the server")
+    parser.add_option("--processes", dest="processes", type="int", default=1, help="number of local processes to run tasks in")
+    parser.add_option("--text-framing", dest="binary_framing", action="store_false", default=True, help="don't negotiate the binary wire format")
+    parser.add_option("--no-compression", dest="compression", action="store_false", default=True, help="don't accept compressed payloads")
+    parser.add_option("--combine-size", dest="combine_size", type="int", default=None, help="apply collectfn whenever a key has this many map values")
+    parser.add_option("--spill-size", dest="spill_size", type="int", default=None, help="spill map output to disk once this many values are held")
+    parser.add_option("--local", dest="local", action="append", default=[], help="file or directory whose data is local to this worker (repeatable)")
+    parser.add_option("--holds", dest="holds", action="append", default=[], help="other locality tag held by this worker (repeatable)")
+    parser.add_option("--persistent", dest="persistent", action="store_true", help="reconnect for the next job when one finishes")
 
     (options, args) = parser.parse_args()
                       
@@ -588,10 +2835,32 @@ def run_client():
     if options.loud:
         logging.basicConfig(level=logging.DEBUG)
 
-    client = Client()
-    client.password = options.password
-    client.conn(args[0], options.port)
+    while True:
+        client = Client()
+        client.password = options.password
+        client.processes = options.processes
+        client.binary_framing = options.binary_framing
+        if not options.compression:
+            client.compressions = []
+        client.combine_size = options.combine_size
+        client.spill_size = options.spill_size
+        client.holds = [os.path.abspath(path) for path in expand_paths(options.local)] + options.holds
+        # Keep every process busy
+        client.prefetch = max(options.prefetch, options.processes)
+        try:
+            client.conn(args[0], options.port)
+        except socket.error:
+            if not options.persistent:
+                raise
+            # No server to talk to yet
+            client.close()
+        if not options.persistent or client.rejected:
+            break
+        time.sleep(1)
                       
 
 if __name__ == '__main__':
+    # Objects the server pickles as mincemeat.* (such as InputSplits) should
+    # resolve to this module's classes
+    sys.modules.setdefault('mincemeat', sys.modules[__name__])
     run_client()